@@ -0,0 +1,353 @@
+import os
+import io
+import json
+import time
+import logging
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import multiprocessing
+import numpy as np
+import pandas
+
+import src.load_data
+from src.instrumentation import peak_rss_mb
+import src.features.utils as ml_utils
+from src.features import coordinates
+
+# (latitude, longitude, spread in degrees, weight) of typical pickup areas.
+HOTSPOTS = [
+    (40.758, -73.985, 0.015, 0.45),  # Midtown
+    (40.720, -74.000, 0.012, 0.25),  # Downtown
+    (40.780, -73.955, 0.015, 0.15),  # Upper East/West Side
+    (40.645, -73.785, 0.006, 0.07),  # JFK
+    (40.774, -73.872, 0.004, 0.05),  # LaGuardia
+    (40.690, -73.950, 0.030, 0.03),  # Brooklyn
+]
+OUTLIER_FRACTION = 0.02
+
+
+def _sample_coordinates(rng, n):
+    weights = np.array([x[3] for x in HOTSPOTS])
+    spot = rng.choice(len(HOTSPOTS), size=n, p=weights / weights.sum())
+    centers = np.array([x[:2] for x in HOTSPOTS])[spot]
+    spread = np.array([x[2] for x in HOTSPOTS])[spot]
+    coordinates = centers + rng.normal(size=(n, 2)) * spread[:, None]
+    outliers = rng.random(n) < OUTLIER_FRACTION
+    coordinates[outliers] = 0
+    return coordinates.astype(np.float32)
+
+
+def synthetic_rides(n, type_="train", seed=0):
+    rng = np.random.default_rng(seed)
+    pickup = _sample_coordinates(rng, n)
+    dropoff = _sample_coordinates(rng, n)
+    start = pandas.Timestamp("2009-01-01").value // 10**9
+    end = pandas.Timestamp("2015-07-01").value // 10**9
+    days = (rng.integers(start, end, size=n) // 86400) * 86400
+    # Rides concentrate in the evening and are rare around 5am.
+    hour_weights = 1.2 + np.sin((np.arange(24) - 11) * np.pi / 12)
+    hours = rng.choice(24, size=n, p=hour_weights / hour_weights.sum())
+    seconds = days + hours * 3600 + rng.integers(0, 3600, size=n)
+    timestamp = pandas.to_datetime(seconds, unit="s")
+    distance = ml_utils.GeographicalDistance().transform(
+        np.concatenate([pickup, dropoff], axis=1).astype(float)
+    )
+    fare = 2.5 + 1.56 * np.minimum(distance.reshape(-1), 60)
+    fare = np.round(fare * rng.lognormal(0, 0.2, size=n), 2)
+    df = pandas.DataFrame(
+        {
+            "key": timestamp.strftime("%Y-%m-%d %H:%M:%S.")
+            + pandas.Index(np.arange(n).astype(str)),
+            "fare_amount": fare.astype(np.float32),
+            "pickup_datetime": timestamp.strftime("%Y-%m-%d %H:%M:%S UTC"),
+            "pickup_longitude": pickup[:, 1],
+            "pickup_latitude": pickup[:, 0],
+            "dropoff_longitude": dropoff[:, 1],
+            "dropoff_latitude": dropoff[:, 0],
+            "passenger_count": rng.choice(
+                [1, 2, 3, 4, 5, 6], size=n, p=[0.69, 0.15, 0.04, 0.02, 0.07, 0.03]
+            ).astype(np.int32),
+        }
+    )
+    if type_ != "train":
+        df = df.drop(columns=["fare_amount"])
+    return df
+
+
+def synthetic_districts(rows=4, cols=4, bounds=((40.55, 40.90), (-74.05, -73.75))):
+    (lat0, lat1), (lon0, lon1) = bounds
+    lat_edges = np.linspace(lat0, lat1, rows + 1)
+    lon_edges = np.linspace(lon0, lon1, cols + 1)
+    features = []
+    for i in range(rows):
+        for j in range(cols):
+            ring = [
+                [lon_edges[j], lat_edges[i]],
+                [lon_edges[j + 1], lat_edges[i]],
+                [lon_edges[j + 1], lat_edges[i + 1]],
+                [lon_edges[j], lat_edges[i + 1]],
+                [lon_edges[j], lat_edges[i]],
+            ]
+            features.append(
+                {
+                    "type": "Feature",
+                    "properties": {
+                        "BoroName": "District {}".format(i * cols + j),
+                        "AssemDist": i * cols + j,
+                    },
+                    "geometry": {"type": "Polygon", "coordinates": [ring]},
+                }
+            )
+    return {"type": "FeatureCollection", "features": features}
+
+
+def _write_parts(folder, n, parts=4):
+    os.makedirs(os.path.join(folder, "raw"), exist_ok=True)
+    df = synthetic_rides(n)
+    with io.StringIO(df.to_csv(index=False)) as f:
+        df = src.load_data._parse_data(f, "train", 0)
+    files = []
+    for position, part in enumerate(np.array_split(np.arange(n), parts)):
+        fl = os.path.join(folder, "raw", "parts_train{:02d}.parquet".format(position))
+        df.iloc[part].to_parquet(fl)
+        files.append(fl)
+    return files
+
+
+def _region_index(region_id="BoroName"):
+    from src.external.geography import convert_hexagon
+
+    df_area = convert_hexagon(synthetic_districts(), 9, as_integer=True)
+    return coordinates.build_region_index(df_area, region_id)
+
+
+def _location_frame(df_hexagon, index, region_id):
+    return coordinates.find_location(df_hexagon, index, "pickup", region_id).join(
+        coordinates.find_location(df_hexagon, index, "dropoff", region_id)
+    )
+
+
+def _setup_parse_data(folder, n):
+    return synthetic_rides(n).to_csv(index=False)
+
+
+def _run_parse_data(state):
+    with io.StringIO(state) as f:
+        return src.load_data._parse_data(f, "train", 0)
+
+
+def _setup_get_hexagon(folder, n):
+    return pandas.read_parquet(_write_parts(folder, n, parts=1)[0])
+
+
+def _run_get_hexagon(state):
+    df = coordinates.get_hexagon(state, "pickup", 15)
+    return coordinates.get_hexagon(df, "dropoff", 15)
+
+
+def _setup_find_location(folder, n):
+    df = _run_get_hexagon(_setup_get_hexagon(folder, n))
+    return df, _region_index()
+
+
+def _run_find_location(state):
+    df, index = state
+    coordinates.find_location(df, index, "pickup", "BoroName")
+    return coordinates.find_location(df, index, "dropoff", "BoroName")
+
+
+def _setup_convert_hexagon(folder, n):
+    side = max(1, int(np.sqrt(n / 10000)))
+    return synthetic_districts(rows=side, cols=side)
+
+
+def _run_convert_hexagon(state):
+    from src.external.geography import convert_hexagon
+
+    return convert_hexagon(state, 10, as_integer=True)
+
+
+def _setup_files(folder, n):
+    return _write_parts(folder, n)
+
+
+def _setup_location_files(folder, n):
+    index = _region_index()
+    files = []
+    for fl in _write_parts(folder, n):
+        df = _location_frame(_run_get_hexagon(pandas.read_parquet(fl)), index, "BoroName")
+        fl_save = fl.replace("parts_train", "borough_parts_train")
+        df.to_parquet(fl_save)
+        files.append(fl_save)
+    return files
+
+
+def _setup_arrays(folder, n):
+    return ml_utils.GeographicalCoordinates().transform(_write_parts(folder, n))
+
+
+def _setup_timestamps(folder, n):
+    return ml_utils.Timestamp_Week().transform(_write_parts(folder, n))
+
+
+def _setup_generate_features(folder, n):
+    from src.features.pre_processing import LOCATION_FEATURES, LOCATION_TYPES
+
+    # Refined hexagon and location files as the pipeline names them, so the
+    # location and route_stats stages run too.
+    folder_refined = os.path.join(folder, "refined")
+    os.makedirs(folder_refined)
+    indexes = {
+        name: (_region_index(region_id), region_id)
+        for name, region_id in LOCATION_FEATURES.items()
+    }
+    for fl in _write_parts(folder, n):
+        base = os.path.basename(fl)
+        df = _run_get_hexagon(pandas.read_parquet(fl)).filter(regex="hexagon")
+        df.to_parquet(os.path.join(folder_refined, "hexagon_" + base))
+        for name, (index, region_id) in indexes.items():
+            df_location = _location_frame(df, index, region_id)
+            fl_save = os.path.join(folder_refined, LOCATION_TYPES[name] + "_" + base)
+            df_location.to_parquet(fl_save)
+    src.load_data.DATA_FOLDER = folder
+    os.makedirs(os.path.join(folder, "features"))
+    return os.path.join(folder, "features")
+
+
+def _run_generate_features(state):
+    from src.features.pre_processing import generate_features
+
+    # A new output folder per repetition so cached features are not reused.
+    generate_features(tempfile.mkdtemp(dir=state))
+
+
+def _transformer_case(cls, setup=_setup_files, *args):
+    return setup, lambda state: cls(*args).transform(state)
+
+
+CASES = {
+    "parse_data": (_setup_parse_data, _run_parse_data),
+    "get_hexagon": (_setup_get_hexagon, _run_get_hexagon),
+    "find_location": (_setup_find_location, _run_find_location),
+    "convert_hexagon": (_setup_convert_hexagon, _run_convert_hexagon),
+    "FareAmount": _transformer_case(ml_utils.FareAmount),
+    "PassengerCount": _transformer_case(ml_utils.PassengerCount),
+    "GeographicalBoundingBox": _transformer_case(ml_utils.GeographicalBoundingBox),
+    "GeographicalCoordinates": _transformer_case(ml_utils.GeographicalCoordinates),
+    "GeographicalDistance": _transformer_case(
+        ml_utils.GeographicalDistance, _setup_arrays
+    ),
+    "Timestamp_Week": _transformer_case(ml_utils.Timestamp_Week),
+    "PrimaryKey": _transformer_case(ml_utils.PrimaryKey),
+    "FourierSeries": _transformer_case(ml_utils.FourierSeries, _setup_timestamps, 24, 4),
+    "Location": _transformer_case(ml_utils.Location, _setup_location_files),
+    "generate_features": (_setup_generate_features, _run_generate_features),
+}
+
+
+def _run_case(name, rows, repeat):
+    setup, run = CASES[name]
+    with tempfile.TemporaryDirectory() as folder:
+        state = setup(folder, rows)
+        rss_before = peak_rss_mb()
+        timings = []
+        for _ in range(repeat):
+            start_wall, start_cpu = time.perf_counter(), time.process_time()
+            run(state)
+            timings.append(
+                (time.perf_counter() - start_wall, time.process_time() - start_cpu)
+            )
+        rss_peak = peak_rss_mb()
+        # tracemalloc slows every allocation down, so it gets its own untimed run
+        # after the RSS high-water mark is read.
+        tracemalloc.start()
+        run(state)
+        _, peak_traced = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    wall, cpu = min(timings)
+    return {
+        "case": name,
+        "rows": rows,
+        "seconds": wall,
+        "first_seconds": timings[0][0],
+        "cpu_seconds": cpu,
+        "rows_per_second": rows / wall if wall > 0 else None,
+        "peak_traced_mb": peak_traced / 2**20,
+        "peak_rss_mb": rss_peak,
+        "setup_rss_mb": rss_before,
+    }
+
+
+def run_benchmarks(cases, row_counts, repeat=3):
+    results = []
+    # A fresh interpreter per case keeps the RSS high-water mark comparable.
+    context = multiprocessing.get_context("spawn")
+    for rows in row_counts:
+        for name in cases:
+            with context.Pool(1) as pool:
+                result = pool.apply(_run_case, (name, rows, repeat))
+            logging.info(
+                "{case} rows={rows} {seconds:.3f}s peak_rss={peak_rss_mb:.0f}MB".format(
+                    **result
+                )
+            )
+            results.append(result)
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "pandas": pandas.__version__,
+            "machine": platform.machine(),
+            "cpu_count": os.cpu_count(),
+            "repeat": repeat,
+        },
+        "results": results,
+    }
+
+
+def compare_reports(report, baseline, tolerance=0.2):
+    previous = {(x["case"], x["rows"]): x for x in baseline["results"]}
+    regressions = []
+    for result in report["results"]:
+        before = previous.get((result["case"], result["rows"]))
+        if before is None:
+            continue
+        for metric in ["seconds", "peak_rss_mb"]:
+            if result[metric] > before[metric] * (1 + tolerance):
+                regressions.append(
+                    {
+                        "case": result["case"],
+                        "rows": result["rows"],
+                        "metric": metric,
+                        "baseline": before[metric],
+                        "current": result[metric],
+                    }
+                )
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", default="10000,100000")
+    parser.add_argument("--cases", default=None)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", default="benchmark.json")
+    parser.add_argument("--baseline", default=None)
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    cases = list(CASES) if args.cases is None else args.cases.split(",")
+    row_counts = [int(x) for x in args.rows.split(",")]
+    report = run_benchmarks(cases, row_counts, args.repeat)
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            report["regressions"] = compare_reports(report, json.load(f), args.tolerance)
+        for regression in report["regressions"]:
+            logging.warning("Regression {}".format(regression))
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    logging.info("Saved {}".format(args.output))
@@ -0,0 +1,102 @@
+import os
+import json
+import hashlib
+import inspect
+import logging
+
+from src.parallel import atomic_path
+
+MANIFEST_SUFFIX = ".manifest.json"
+_FILE_HASHES = {}
+
+
+def manifest_path(fl_output):
+    return fl_output + MANIFEST_SUFFIX
+
+
+def read_manifest(fl_output):
+    fl = manifest_path(fl_output)
+    if not os.path.exists(fl):
+        return None
+    with open(fl) as f:
+        return json.load(f)
+
+
+def file_hash(path, block_size=1 << 20):
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def code_hash(*objects):
+    digest = hashlib.sha1()
+    for obj in objects:
+        digest.update(inspect.getsource(obj).encode("utf8"))
+    return digest.hexdigest()
+
+
+def _describe_input(path, previous=None):
+    stat = os.stat(path)
+    description = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    # Reuse the recorded content hash while size and mtime are unchanged.
+    if (
+        previous is not None
+        and previous.get("size") == description["size"]
+        and previous.get("mtime_ns") == description["mtime_ns"]
+    ):
+        description["sha1"] = previous["sha1"]
+    else:
+        # Shared by every artifact in this process, so an input is hashed once.
+        key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        if key not in _FILE_HASHES:
+            _FILE_HASHES[key] = file_hash(path)
+        description["sha1"] = _FILE_HASHES[key]
+    return description
+
+
+def _artifact_key(inputs, params):
+    digest = hashlib.sha1()
+    digest.update(json.dumps(params, sort_keys=True, default=str).encode("utf8"))
+    for path in sorted(inputs):
+        digest.update("{}:{}\n".format(path, inputs[path]["sha1"]).encode("utf8"))
+    return digest.hexdigest()
+
+
+def is_fresh(fl_output, input_paths, params):
+    manifest = read_manifest(fl_output)
+    if manifest is None:
+        return False
+    outputs = manifest.get("outputs", [fl_output])
+    if not all(os.path.exists(x) for x in outputs):
+        return False
+    recorded = manifest.get("inputs", {})
+    if sorted(recorded) != sorted(input_paths):
+        return False
+    inputs = {p: _describe_input(p, recorded.get(p)) for p in input_paths}
+    return manifest["key"] == _artifact_key(inputs, params)
+
+
+def record(fl_output, input_paths, params, outputs=None):
+    previous = read_manifest(fl_output) or {}
+    recorded = previous.get("inputs", {})
+    inputs = {p: _describe_input(p, recorded.get(p)) for p in input_paths}
+    manifest = {
+        "key": _artifact_key(inputs, params),
+        "params": params,
+        "inputs": inputs,
+    }
+    if outputs is not None:
+        manifest["outputs"] = list(outputs)
+    with atomic_path(manifest_path(fl_output)) as fl_tmp:
+        with open(fl_tmp, "w") as f:
+            json.dump(manifest, f, indent=2, default=str)
+    return manifest
+
+
+def skip_if_fresh(fl_output, input_paths, params):
+    if is_fresh(fl_output, input_paths, params):
+        logging.info("Up to date {}".format(fl_output))
+        return True
+    return False
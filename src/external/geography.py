@@ -1,4 +1,4 @@
-import functools
+import hashlib
 import logging
 from h3 import h3
 import requests
@@ -9,46 +9,115 @@ import geopandas
 import io
 import pandas
 
+import src.instrumentation as instrumentation
+from src.parallel import atomic_path, atomic_write_parquet, run_parallel
 
-def download_geojson(folder_output, datasets=None):
-    saved_files = []
+
+def _get_links(datasets=None):
     if datasets is not None:
         datasets = [x.strip() for x in datasets.split(",")]
     this_folder = os.path.dirname(__file__)
     with open(os.path.join(this_folder, "geography_links.json")) as f:
         links = json.load(f)
-    for elem in links:
-        if (datasets is None) or (elem["name"] in datasets):
-            req = requests.get(elem["link"])
-            if req.status_code == 200:
-                fl_save = os.path.join(
-                    folder_output,
-                    "{}_{}.geojson".format(elem["name"], elem["boundary"]),
-                )
-                with open(fl_save, "w") as f:
-                    f.write(req.text)
-                logging.info("Saved {}".format(fl_save))
-                saved_files.append(fl_save)
+    return [elem for elem in links if (datasets is None) or (elem["name"] in datasets)]
+
+
+def download_geojson(folder_output, datasets=None):
+    saved_files = []
+    for elem in _get_links(datasets):
+        req = requests.get(elem["link"])
+        if req.status_code == 200:
+            fl_save = os.path.join(
+                folder_output,
+                "{}_{}.geojson".format(elem["name"], elem["boundary"]),
+            )
+            with open(fl_save, "w") as f:
+                f.write(req.text)
+            logging.info("Saved {}".format(fl_save))
+            saved_files.append(fl_save)
     return saved_files
 
 
-def shape_to_hexagons(shape, resolution):
-    if shape.type == "Polygon":
-        hexagons = h3.compact(
-            h3.polyfill(shape.__geo_interface__, resolution, geo_json_conformant=True)
+def find_geojson(folder_output, datasets=None):
+    saved_files = []
+    for elem in _get_links(datasets):
+        fl = os.path.join(
+            folder_output, "{}_{}.geojson".format(elem["name"], elem["boundary"])
         )
-    elif shape.type == "MultiPolygon":
-        hexagons = []
-        for g in shape.geoms:
-            hexagons += shape_to_hexagons(g, resolution)
+        if os.path.exists(fl):
+            saved_files.append(fl)
+        else:
+            logging.warning("Missing {}".format(fl))
+    return saved_files
+
+
+def polygon_parts(shape):
+    if shape.type == "Polygon":
+        return [shape.__geo_interface__]
+    if shape.type == "MultiPolygon":
+        return [g.__geo_interface__ for g in shape.geoms]
+    return []
+
+
+def polyfill_polygon(geo_interface, resolution):
+    hexagons = h3.compact(
+        h3.polyfill(geo_interface, resolution, geo_json_conformant=True)
+    )
     return list(hexagons)
 
 
-def convert_hexagon(geojson, resolution, as_integer):
+def shape_to_hexagons(shape, resolution):
+    hexagons = []
+    for part in polygon_parts(shape):
+        hexagons += polyfill_polygon(part, resolution)
+    return hexagons
+
+
+def geometry_hash(geometry, resolution):
+    content = json.dumps(geometry, sort_keys=True).encode("utf8")
+    return "{}_r{}".format(hashlib.sha1(content).hexdigest(), resolution)
+
+
+def _polyfill_shapes(shapes, keys, resolution, workers, cache_folder):
+    hexagons = [None] * len(shapes)
+    missing = []
+    for position, key in enumerate(keys):
+        fl_cache = os.path.join(cache_folder or "", key + ".json")
+        if cache_folder is not None and os.path.exists(fl_cache):
+            with open(fl_cache) as f:
+                hexagons[position] = json.load(f)
+        else:
+            missing.append(position)
+    tasks = [
+        (part, resolution)
+        for position in missing
+        for part in polygon_parts(shapes[position])
+    ]
+    logging.info(
+        "Polyfill {} shapes ({} cached)".format(len(missing), len(keys) - len(missing))
+    )
+    with instrumentation.stage("polyfill", rows=len(tasks)):
+        results = iter(run_parallel(polyfill_polygon, tasks, workers))
+    for position in missing:
+        hexagons[position] = []
+        for _ in polygon_parts(shapes[position]):
+            hexagons[position] += next(results)
+        if cache_folder is not None:
+            fl_cache = os.path.join(cache_folder, keys[position] + ".json")
+            with atomic_path(fl_cache) as fl_tmp:
+                with open(fl_tmp, "w") as f:
+                    json.dump(hexagons[position], f)
+    return hexagons
+
+
+def convert_hexagon(geojson, resolution, as_integer, workers=1, cache_folder=None):
     with io.StringIO(json.dumps(geojson)) as f:
         dfgeo = geopandas.read_file(f)
-    dfgeo["hexagons"] = dfgeo["geometry"].apply(
-        functools.partial(shape_to_hexagons, resolution=resolution)
+    keys = [geometry_hash(x["geometry"], resolution) for x in geojson["features"]]
+    if cache_folder is not None:
+        os.makedirs(cache_folder, exist_ok=True)
+    dfgeo["hexagons"] = _polyfill_shapes(
+        list(dfgeo["geometry"]), keys, resolution, workers, cache_folder
     )
     dfgeo = pandas.DataFrame(dfgeo.drop("geometry", axis=1))
     if as_integer:
@@ -58,14 +127,22 @@ def convert_hexagon(geojson, resolution, as_integer):
     return dfgeo
 
 
-def process_geometry(folder_output, datasets, resolution=11, as_integer=True):
-    saved_files = download_geojson(folder_output, datasets)
+def process_geometry(
+    folder_output, datasets, resolution=11, as_integer=True, workers=1, offline=False
+):
+    if offline:
+        saved_files = find_geojson(folder_output, datasets)
+    else:
+        saved_files = download_geojson(folder_output, datasets)
+    cache_folder = os.path.join(folder_output, "hexagon_cache")
     for fl in saved_files:
         with open(fl) as f:
             geojson = json.load(f)
-        df = convert_hexagon(geojson, resolution, as_integer)
+        with instrumentation.stage("convert_hexagon", fl, rows=len(geojson["features"])):
+            df = convert_hexagon(geojson, resolution, as_integer, workers, cache_folder)
         fl_save = fl.replace(".geojson", ".parquet")
-        df.to_parquet(fl_save)
+        with instrumentation.stage("parquet_write", fl_save, rows=len(df)):
+            atomic_write_parquet(df, fl_save)
         logging.info("Saved {}".format(fl_save))
 
 
@@ -73,8 +150,20 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--folder")
     parser.add_argument("--datasets", default=None)
+    parser.add_argument("--resolution", type=int, default=11)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--offline", action="store_true")
+    instrumentation.add_arguments(parser)
     args = parser.parse_args()
 
     logging.basicConfig(level=logging.INFO)
+    instrumentation.configure_from_args(args)
 
-    process_geometry(args.folder, args.datasets)
+    process_geometry(
+        args.folder,
+        args.datasets,
+        resolution=args.resolution,
+        workers=args.workers,
+        offline=args.offline,
+    )
+    instrumentation.finish(args)
@@ -0,0 +1,250 @@
+import os
+import glob
+import logging
+import argparse
+import numpy as np
+import pandas
+
+import src.cache as cache
+import src.instrumentation as instrumentation
+from src.load_data import DATA_FOLDER, get_data_files
+from src.parallel import atomic_write_parquet, run_parallel
+from src.features.coordinates import (
+    REGION_IDS,
+    decode_region_codes,
+    h3_to_parent_array,
+    load_region_dictionary,
+    region_code_columns,
+    region_dictionary_path,
+)
+
+AGGREGATES_FOLDER = os.path.join(DATA_FOLDER, "aggregates")
+HEXAGON_RESOLUTION = 9
+MEASURES = ["count", "fare_sum"]
+
+
+def hour_of_week(timestamps):
+    # Monday 00h is 0, as in the notebook's convert_hour_int.
+    hours = timestamps.astype("datetime64[h]").astype(np.int64)
+    days = hours // 24
+    return ((days + 3) % 7) * 24 + hours % 24
+
+
+def _aggregate(df, keys):
+    df_out = df.groupby(keys, sort=False).agg(
+        count=("fare_amount", "size"), fare_sum=("fare_amount", "sum")
+    )
+    return df_out.reset_index()
+
+
+def time_cube(df):
+    df_time = pandas.DataFrame(
+        {
+            "hour": df["pickup_datetime"].values.astype("datetime64[h]"),
+            "fare_amount": df["fare_amount"].values,
+        }
+    )
+    return _aggregate(df_time.dropna(subset=["hour"]), ["hour"])
+
+
+def hexagon_cube(df, df_hexagon, prefix, resolution=HEXAGON_RESOLUTION):
+    column = prefix + "_hexagon"
+    hexagons = df_hexagon[column].values.astype(np.uint64)
+    valid = (hexagons > 0) & df["pickup_datetime"].notna().values
+    df_hex = pandas.DataFrame(
+        {
+            "hour_of_week": hour_of_week(df["pickup_datetime"].values[valid]),
+            column: h3_to_parent_array(hexagons[valid], resolution),
+            "fare_amount": df["fare_amount"].values[valid],
+        }
+    )
+    return _aggregate(df_hex, ["hour_of_week", column])
+
+
+def region_pair_cube(df, df_region, region_id, labels=None):
+    columns = [x + "_" + region_id for x in ["pickup", "dropoff"]]
+    df_pair = df_region[columns].reset_index(drop=True)
+    if labels is not None:
+        # Compact region files hold int16 codes; a missing region (-1) becomes NaN
+        # and is dropped by the groupby, as in the wide files.
+        for column in columns:
+            df_pair[column] = decode_region_codes(df_pair[column].values, labels).values
+    df_pair["fare_amount"] = df["fare_amount"].values
+    return _aggregate(df_pair, columns)
+
+
+def _refined_files(base, raster=False):
+    folder_refined = os.path.join(DATA_FOLDER, "refined")
+    fl_hexagon = os.path.join(folder_refined, "hexagon_" + base)
+    # Exact location files come first so they win over the raster approximation
+    # when both hold the same columns; the raster is only read on request.
+    region_files = [
+        os.path.join(folder_refined, location_type + "_" + base)
+        for location_type in sorted(REGION_IDS)
+    ]
+    if raster:
+        region_files.append(os.path.join(folder_refined, "regions_" + base))
+    return fl_hexagon, [x for x in region_files if os.path.exists(x)]
+
+
+def _read_regions(region_files):
+    frames, compact = [], {}
+    for fl in region_files:
+        frames.append(pandas.read_parquet(fl))
+        codes = region_code_columns(fl)
+        # Duplicate columns keep the first file, and so does their compact flag.
+        for column in frames[-1].columns:
+            compact.setdefault(column, column in codes)
+    df_region = pandas.concat(frames, axis=1)
+    df_region = df_region.loc[:, ~df_region.columns.duplicated()]
+    region_ids = [
+        x[len("pickup_"):]
+        for x in df_region.columns
+        if x.startswith("pickup_") and "dropoff_" + x[len("pickup_"):] in df_region
+    ]
+    return df_region, region_ids, compact
+
+
+def _process_partial_file(fl, folder_output, resolution, raster=False):
+    _, base = os.path.split(fl)
+    folder_partial = os.path.join(folder_output, "partials")
+    fl_hexagon, region_files = _refined_files(base, raster)
+    folder_refined = os.path.dirname(fl_hexagon)
+    inputs = [fl] + [x for x in [fl_hexagon] if os.path.exists(x)] + region_files
+    inputs += sorted(glob.glob(region_dictionary_path(folder_refined, "*")))
+    fl_manifest = os.path.join(folder_partial, base)
+    params = {
+        "stage": "aggregates",
+        "resolution": resolution,
+        "raster": raster,
+        "code": cache.code_hash(
+            hour_of_week,
+            _aggregate,
+            time_cube,
+            hexagon_cube,
+            region_pair_cube,
+        ),
+    }
+    if cache.skip_if_fresh(fl_manifest, inputs, params):
+        outputs = cache.read_manifest(fl_manifest)["outputs"]
+        return {os.path.split(x)[1][: -len(base) - 1]: x for x in outputs}
+    with instrumentation.stage("parquet_read", fl) as record:
+        df = pandas.read_parquet(fl, columns=["pickup_datetime", "fare_amount"])
+        record["rows"] = len(df)
+    cubes = {}
+    with instrumentation.stage("aggregate", fl, rows=len(df)):
+        cubes["time"] = time_cube(df)
+        if os.path.exists(fl_hexagon):
+            df_hexagon = pandas.read_parquet(fl_hexagon)
+            for prefix in ["pickup", "dropoff"]:
+                cubes[prefix + "_hexagon"] = hexagon_cube(
+                    df, df_hexagon, prefix, resolution
+                )
+        if region_files:
+            df_region, region_ids, compact = _read_regions(region_files)
+            for region_id in region_ids:
+                labels = None
+                if compact["pickup_" + region_id]:
+                    labels = load_region_dictionary(folder_refined, region_id)
+                cubes["region_pair_" + region_id] = region_pair_cube(
+                    df, df_region, region_id, labels
+                )
+    outputs = {}
+    for name, df_cube in cubes.items():
+        outputs[name] = os.path.join(folder_partial, name + "_" + base)
+        atomic_write_parquet(df_cube, outputs[name])
+    cache.record(fl_manifest, inputs, params, outputs=list(outputs.values()))
+    logging.info("Saved {}".format(fl_manifest))
+    return outputs
+
+
+def merge_cube(folder_output, name, partial_files):
+    fl_save = os.path.join(folder_output, name + ".parquet")
+    params = {"stage": "aggregates_merge", "name": name}
+    if cache.skip_if_fresh(fl_save, partial_files, params):
+        return fl_save
+    with instrumentation.stage("aggregate_merge", fl_save) as record:
+        df = pandas.concat([pandas.read_parquet(x) for x in partial_files])
+        keys = [x for x in df.columns if x not in MEASURES]
+        df = df.groupby(keys, as_index=False)[MEASURES].sum()
+        record["rows"] = len(df)
+    atomic_write_parquet(df, fl_save)
+    cache.record(fl_save, partial_files, params)
+    logging.info("Saved {}".format(fl_save))
+    return fl_save
+
+
+def process_aggregates(
+    folder_output=AGGREGATES_FOLDER,
+    resolution=HEXAGON_RESOLUTION,
+    workers=1,
+    raster=False,
+):
+    os.makedirs(os.path.join(folder_output, "partials"), exist_ok=True)
+    files_train, _ = get_data_files()
+    tasks = [(fl, folder_output, resolution, raster) for fl in files_train]
+    partials = {}
+    for outputs in run_parallel(_process_partial_file, tasks, workers):
+        for name, fl in outputs.items():
+            partials.setdefault(name, []).append(fl)
+    return {
+        name: merge_cube(folder_output, name, sorted(fls))
+        for name, fls in partials.items()
+    }
+
+
+def load_cube(name, folder=AGGREGATES_FOLDER):
+    return pandas.read_parquet(os.path.join(folder, name + ".parquet"))
+
+
+def rollup(df_cube, keys):
+    df = df_cube.groupby(keys, as_index=False)[MEASURES].sum()
+    df["fare_mean"] = df["fare_sum"] / df["count"]
+    return df
+
+
+def by_day(df_time):
+    return rollup(df_time.assign(day=df_time["hour"].dt.floor("D")), ["day"])
+
+
+def by_hour_of_week(df_time):
+    df = df_time.assign(hour_int=hour_of_week(df_time["hour"].values))
+    return rollup(df, ["hour_int"])
+
+
+def by_hour(df_time, days=None):
+    if days is not None:
+        df_time = df_time[df_time["hour"].dt.floor("D").isin(days)]
+    return rollup(df_time, ["hour"])
+
+
+def by_hexagon(df_hexagon, resolution=None, hours_of_week=None):
+    column = [x for x in df_hexagon.columns if x.endswith("_hexagon")][0]
+    if hours_of_week is not None:
+        df_hexagon = df_hexagon[df_hexagon["hour_of_week"].isin(hours_of_week)]
+    if resolution is not None:
+        parents = h3_to_parent_array(df_hexagon[column].values, resolution)
+        df_hexagon = df_hexagon.assign(**{column: parents})
+    return rollup(df_hexagon, [column])
+
+
+def by_region_pair(df_pair, region_id):
+    return rollup(df_pair, [x + "_" + region_id for x in ["pickup", "dropoff"]])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--folder", default=AGGREGATES_FOLDER)
+    parser.add_argument("--resolution", type=int, default=HEXAGON_RESOLUTION)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--raster", action="store_true")
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    instrumentation.configure_from_args(args)
+
+    process_aggregates(
+        args.folder, args.resolution, workers=args.workers, raster=args.raster
+    )
+    instrumentation.finish(args)
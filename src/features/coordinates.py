@@ -1,13 +1,40 @@
 from h3 import h3
+import numpy as np
 import pandas
+import pyarrow.parquet
 import os
+import json
 import logging
 import argparse
 import itertools
-import glob
+import warnings
 
+with warnings.catch_warnings():
+    warnings.simplefilter("ignore")
+    from h3.unstable import vect as h3_vect
 
-from src.load_data import DATA_FOLDER, get_data_files
+
+import src.cache as cache
+import src.instrumentation as instrumentation
+from src.load_data import DATA_FOLDER, get_data_files, get_refined_files
+from src.parallel import atomic_path, atomic_write_parquet, run_parallel
+
+
+def geo_to_hexagon_array(latitude, longitude, resolution):
+    latitude = np.ascontiguousarray(latitude, dtype=np.float32)
+    longitude = np.ascontiguousarray(longitude, dtype=np.float32)
+    # Pack each (lat, lon) float32 pair into one uint64 so that repeated
+    # coordinates (airports, hotels, ...) are only indexed once.
+    packed = (latitude.view(np.uint32).astype(np.uint64) << np.uint64(32)) | (
+        longitude.view(np.uint32).astype(np.uint64)
+    )
+    unique, inverse = np.unique(packed, return_inverse=True)
+    unique_lat = (unique >> np.uint64(32)).astype(np.uint32).view(np.float32)
+    unique_lon = (unique & np.uint64(0xFFFFFFFF)).astype(np.uint32).view(np.float32)
+    cells = h3_vect.geo_to_h3(
+        unique_lat.astype(np.float64), unique_lon.astype(np.float64), resolution
+    )
+    return cells.astype(np.uint64)[inverse.reshape(-1)]
 
 
 def get_hexagon(df, prefix, resolution, as_integer=True):
@@ -22,76 +49,246 @@ def get_hexagon(df, prefix, resolution, as_integer=True):
         & (df["dropoff_latitude"] < max_lat)
         & (df["dropoff_longitude"] > min_lon)
         & (df["dropoff_longitude"] < max_lon)
-    )
+    ).values
     column = prefix + "_hexagon"
-    df.loc[flter, column] = df.loc[flter].apply(
-        lambda row: h3.geo_to_h3(
-            row[prefix + "_latitude"], row[prefix + "_longitude"], resolution
-        ),
-        axis=1,
+    hexagons = np.zeros(len(df), dtype=np.uint64)
+    hexagons[flter] = geo_to_hexagon_array(
+        df[prefix + "_latitude"].values[flter],
+        df[prefix + "_longitude"].values[flter],
+        resolution,
     )
     if as_integer:
-        df[column] = df[column].fillna("0").apply(lambda x: int(x, 16))
+        df[column] = hexagons
+    else:
+        df[column] = [h3.h3_to_string(int(x)) if x > 0 else None for x in hexagons]
     return df
 
 
+REGION_IDS = {
+    "borough_shoreline": "BoroName",
+    "borough_water": "BoroName",
+    "state_assembly_shoreline": "AssemDist",
+    "state_assembly_water": "AssemDist",
+    "state_senate_shoreline": "StSenDist",
+    "state_senate_water": "StSenDist",
+    "national_congress_shoreline": "CongDist",
+    "national_congress_water": "CongDist",
+}
+
+H3_RESOLUTION_OFFSET = 52
+H3_RESOLUTION_MASK = np.uint64(0xF << H3_RESOLUTION_OFFSET)
+REGION_CODE_DTYPE = np.int16
+REGION_CODES_METADATA = b"region_codes"
+
+
+def h3_get_resolution_array(cells):
+    cells = np.asarray(cells, dtype=np.uint64)
+    return ((cells & H3_RESOLUTION_MASK) >> np.uint64(H3_RESOLUTION_OFFSET)).astype(
+        np.int8
+    )
+
+
+def h3_to_parent_array(cells, resolution):
+    # Set the resolution field and mark every finer digit as unused (0b111).
+    cells = np.asarray(cells, dtype=np.uint64)
+    unused_digits = np.uint64((1 << (3 * (15 - resolution))) - 1)
+    resolution_bits = np.uint64(resolution << H3_RESOLUTION_OFFSET)
+    return (cells & ~H3_RESOLUTION_MASK) | resolution_bits | unused_digits
+
+
 def get_external_shapes(name):
     fl = os.path.join(DATA_FOLDER, "external", name + ".parquet")
     df = pandas.read_parquet(fl)
     return df
 
 
-def find_location(df_points, df_area, prefix, region_id):
-    col = prefix + "_hexagon_ls"
-    df_points[col] = df_points[prefix + "_hexagon"].apply(
-        lambda s: [int(h3.h3_to_parent(hex(s)[2:], res=r), 16) for r in range(1, 16)]
-        if isinstance(s, int) and s > 0
-        else []
-    )
-    dfA = df_area[[region_id, "hexagons"]].explode("hexagons").dropna()
-    dfB = (
-        df_points.reset_index()[["index", col]]
-        .explode(col)
-        .rename(columns={col: "hexagons"})
-        .dropna()
-    )
-    dfA["hexagons"] = dfA["hexagons"].astype(int)
-    dfB["hexagons"] = dfB["hexagons"].astype(int)
-    df = (
-        dfA.merge(dfB, on=["hexagons"])[["index", region_id]]
-        .rename(columns={region_id: prefix + "_" + region_id})
-        .drop_duplicates(subset=["index"])
-        .set_index("index")
+def build_region_index(df_area, region_id):
+    df = df_area[[region_id, "hexagons"]].explode("hexagons").dropna()
+    labels, codes = np.unique(df[region_id].values, return_inverse=True)
+    cells = df["hexagons"].astype(np.uint64).values
+    resolutions = h3_get_resolution_array(cells)
+    order = np.lexsort((cells, resolutions))
+    return {
+        "cells": cells[order],
+        "resolutions": resolutions[order],
+        "codes": codes.reshape(-1)[order].astype(np.int32),
+        "labels": labels,
+    }
+
+
+def save_region_index(index, fl_save):
+    labels = index["labels"]
+    if labels.dtype == object:
+        labels = labels.astype(str)
+    # Written atomically: a truncated index newer than the area file would never
+    # be rebuilt, and parallel workers may build it at the same time.
+    with atomic_path(fl_save) as fl_tmp:
+        with open(fl_tmp, "wb") as f:
+            np.savez(f, **dict(index, labels=labels))
+
+
+def load_region_index(fl):
+    with np.load(fl) as data:
+        index = {key: data[key] for key in data.files}
+    return index
+
+
+def get_region_index(location_type, region_id):
+    fl_area = os.path.join(DATA_FOLDER, "external", location_type + ".parquet")
+    fl_index = os.path.join(
+        DATA_FOLDER, "external", "{}_{}.index.npz".format(location_type, region_id)
     )
-    df = df_points[[]].join(df, how="left")
+    if (not os.path.exists(fl_index)) or (
+        os.path.getmtime(fl_index) < os.path.getmtime(fl_area)
+    ):
+        index = build_region_index(get_external_shapes(location_type), region_id)
+        save_region_index(index, fl_index)
+        logging.info("Saved {}".format(fl_index))
+    return load_region_index(fl_index)
+
+
+def lookup_region_codes(index, hexagons):
+    hexagons = np.asarray(hexagons, dtype=np.uint64)
+    codes = np.full(len(hexagons), -1, dtype=np.int32)
+    valid = hexagons > 0
+    for resolution in np.unique(index["resolutions"]):
+        start, end = np.searchsorted(index["resolutions"], [resolution, resolution + 1])
+        cells = index["cells"][start:end]
+        if len(cells) == 0:
+            continue
+        pending = np.flatnonzero(valid & (codes < 0))
+        if len(pending) == 0:
+            break
+        parents = h3_to_parent_array(hexagons[pending], int(resolution))
+        position = np.minimum(np.searchsorted(cells, parents), len(cells) - 1)
+        found = cells[position] == parents
+        codes[pending[found]] = index["codes"][start:end][position[found]]
+    return codes
+
+
+def decode_region_codes(codes, labels, index=None):
+    codes = np.asarray(codes)
+    return pandas.Series(labels[np.maximum(codes, 0)], index=index).where(codes >= 0)
+
+
+def encode_region_labels(values, labels):
+    codes = pandas.Categorical(values, categories=labels).codes
+    return codes.astype(REGION_CODE_DTYPE)
+
+
+def region_dictionary_path(folder, region_id):
+    return os.path.join(folder, "dictionary_{}.json".format(region_id))
+
+
+def save_region_dictionary(folder, region_id, labels):
+    fl_save = region_dictionary_path(folder, region_id)
+    with atomic_path(fl_save) as fl_tmp:
+        with open(fl_tmp, "w") as f:
+            json.dump(np.asarray(labels).tolist(), f)
+    logging.info("Saved {}".format(fl_save))
+
+
+def load_region_dictionary(folder, region_id):
+    with open(region_dictionary_path(folder, region_id)) as f:
+        return np.array(json.load(f))
+
+
+def region_codes_metadata(columns):
+    # Compact region columns are listed in the parquet schema metadata, since
+    # a wide file with integer labels (e.g. AssemDist) also has an integer dtype.
+    return {REGION_CODES_METADATA: json.dumps(sorted(columns)).encode("utf8")}
+
+
+def region_code_columns(fl):
+    metadata = pyarrow.parquet.read_schema(fl).metadata or {}
+    return set(json.loads(metadata.get(REGION_CODES_METADATA, b"[]")))
+
+
+def find_location(df_points, region_index, prefix, region_id, compact=False):
+    codes = lookup_region_codes(region_index, df_points[prefix + "_hexagon"].values)
+    df = df_points[[]].copy()
+    if compact:
+        df[prefix + "_" + region_id] = codes.astype(REGION_CODE_DTYPE)
+    else:
+        df[prefix + "_" + region_id] = decode_region_codes(
+            codes, region_index["labels"], index=df_points.index
+        )
     return df
 
 
-def process_hexagons(folder_output, resolution=15):
-    files = get_data_files()
-    for fl in itertools.chain(*files):
+def _process_hexagon_file(fl, folder_output, resolution):
+    _, base = os.path.split(fl)
+    fl_save = os.path.join(folder_output, "hexagon_" + base)
+    params = {
+        "stage": "hexagon",
+        "resolution": resolution,
+        "code": cache.code_hash(geo_to_hexagon_array, get_hexagon),
+    }
+    if cache.skip_if_fresh(fl_save, [fl], params):
+        return fl_save
+    with instrumentation.stage("parquet_read", fl) as record:
         df = pandas.read_parquet(fl)
+        record["rows"] = len(df)
+    with instrumentation.stage("hexagon_index", fl, rows=len(df)):
         df = get_hexagon(df, "pickup", resolution)
         df = get_hexagon(df, "dropoff", resolution)
-        _, base = os.path.split(fl)
-        fl_save = os.path.join(folder_output, "hexagon_" + base)
-        df = df.filter(regex="hexagon")
-        df.to_parquet(fl_save)
-        logging.info("Saved {}".format(fl_save))
+    df = df.filter(regex="hexagon")
+    with instrumentation.stage("parquet_write", fl_save, rows=len(df)):
+        atomic_write_parquet(df, fl_save)
+    cache.record(fl_save, [fl], params)
+    logging.info("Saved {}".format(fl_save))
+    return fl_save
 
 
-def process_location(folder_output, location_type, region_id):
-    df_area = get_external_shapes(location_type)
-    files = glob.glob(os.path.join(DATA_FOLDER, "refined", "hexagon_*.parquet"))
-    for fl in sorted(files):
+def process_hexagons(folder_output, resolution=15, workers=1):
+    files = get_data_files()
+    tasks = [(fl, folder_output, resolution) for fl in itertools.chain(*files)]
+    return run_parallel(_process_hexagon_file, tasks, workers)
+
+
+def _process_location_file(
+    fl, folder_output, location_type, region_id, region_index, compact=False
+):
+    _, base = os.path.split(fl)
+    fl_save = os.path.join(folder_output, base.replace("hexagon", location_type))
+    fl_area = os.path.join(DATA_FOLDER, "external", location_type + ".parquet")
+    params = {
+        "stage": "location",
+        "location_type": location_type,
+        "region_id": region_id,
+        "compact": compact,
+        "code": cache.code_hash(
+            lookup_region_codes, find_location, region_codes_metadata
+        ),
+    }
+    if cache.skip_if_fresh(fl_save, [fl, fl_area], params):
+        return fl_save
+    with instrumentation.stage("parquet_read", fl) as record:
         df = pandas.read_parquet(fl)
-        dfA = find_location(df, df_area, prefix="pickup", region_id=region_id)
-        dfB = find_location(df, df_area, prefix="dropoff", region_id=region_id)
+        record["rows"] = len(df)
+    with instrumentation.stage("region_merge", fl, rows=len(df)):
+        dfA = find_location(df, region_index, "pickup", region_id, compact)
+        dfB = find_location(df, region_index, "dropoff", region_id, compact)
         dfsave = df[[]].join(dfA, how="left").join(dfB, how="left")
-        _, base = os.path.split(fl)
-        fl_save = os.path.join(folder_output, base.replace("hexagon", location_type))
-        dfsave.to_parquet(fl_save)
-        logging.info("Saved {}".format(fl_save))
+    metadata = region_codes_metadata(dfsave.columns if compact else [])
+    with instrumentation.stage("parquet_write", fl_save, rows=len(dfsave)):
+        atomic_write_parquet(dfsave, fl_save, metadata)
+    cache.record(fl_save, [fl, fl_area], params)
+    logging.info("Saved {}".format(fl_save))
+    return fl_save
+
+
+def process_location(folder_output, location_type, region_id, workers=1, compact=False):
+    region_index = get_region_index(location_type, region_id)
+    if compact:
+        save_region_dictionary(folder_output, region_id, region_index["labels"])
+    files = get_refined_files("hexagon", itertools.chain(*get_data_files()))
+    tasks = [
+        (fl, folder_output, location_type, region_id, region_index, compact)
+        for fl in files
+        if os.path.exists(fl)
+    ]
+    return run_parallel(_process_location_file, tasks, workers)
 
 
 if __name__ == "__main__":
@@ -99,18 +296,23 @@ if __name__ == "__main__":
     parser.add_argument("--feature")
     parser.add_argument("--folder")
     parser.add_argument("--location_type", default=None)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--compact", action="store_true")
+    instrumentation.add_arguments(parser)
     args = parser.parse_args()
 
     logging.basicConfig(level=logging.INFO)
+    instrumentation.configure_from_args(args)
 
     if args.feature == "hexagon":
-        process_hexagons(args.folder)
+        process_hexagons(args.folder, workers=args.workers)
     if args.feature == "location":
-        region_ids = {
-            "borough_shoreline": "BoroName",
-            "borough_water": "BoroName",
-            "state_assembly_shoreline": "AssemDist",
-            "state_assembly_water": "AssemDist",
-        }
-        region_id = region_ids[args.location_type]
-        process_location(args.folder, args.location_type, region_id)
+        region_id = REGION_IDS[args.location_type]
+        process_location(
+            args.folder,
+            args.location_type,
+            region_id,
+            workers=args.workers,
+            compact=args.compact,
+        )
+    instrumentation.finish(args)
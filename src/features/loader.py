@@ -0,0 +1,205 @@
+import queue
+import logging
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+import src.instrumentation as instrumentation
+import src.features.store as store
+
+_END = object()
+
+
+class FeatureLoader:
+    def __init__(
+        self,
+        folder,
+        features,
+        target=None,
+        batch_size=1024,
+        chunk_rows=65536,
+        shuffle_buffer=262144,
+        prefetch=8,
+        readers=2,
+        shuffle=True,
+        drop_last=False,
+        seed=0,
+        transform=None,
+    ):
+        self.folder = folder
+        self.features = list(features)
+        self.target = target
+        self.batch_size = batch_size
+        self.chunk_rows = chunk_rows
+        self.shuffle_buffer = max(shuffle_buffer, batch_size)
+        self.prefetch = prefetch
+        self.readers = readers
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.transform = transform
+        self.epoch = 0
+        self.manifests = {
+            name: store.read_manifest(folder, name) for name in self._names()
+        }
+        lengths = {m["shape"][0] for m in self.manifests.values()}
+        if len(lengths) != 1:
+            raise ValueError("Features in {} are not aligned".format(folder))
+        self.rows = lengths.pop()
+        # Object (string) features cannot be sliced from a memmap, so they are
+        # unpickled once here instead of once per chunk.
+        self.objects = {
+            name: store.load_feature(folder, name)
+            for name, manifest in self.manifests.items()
+            if manifest["dtype"] == "object"
+        }
+        if self.transform is None and self.objects:
+            raise ValueError(
+                "Features {} are not numeric and need a transform".format(
+                    sorted(self.objects)
+                )
+            )
+
+    def _names(self):
+        return self.features + ([self.target] if self.target else [])
+
+    def __len__(self):
+        if self.drop_last:
+            return self.rows // self.batch_size
+        return -(-self.rows // self.batch_size)
+
+    def _read(self, name, start, stop):
+        if name in self.objects:
+            arr = self.objects[name][start:stop]
+        else:
+            arr = store.take_rows(self.folder, name, slice(start, stop))
+        encoding = dict(self.manifests[name].get("encoding", {}))
+        if self.transform is None:
+            # Dictionary codes stay numeric when they feed the model directly.
+            encoding.pop("dictionary", None)
+        return store.decode_feature(arr, encoding).reshape(stop - start, -1)
+
+    def read_chunk(self, start, stop):
+        with instrumentation.stage("loader_read", self.folder, rows=stop - start):
+            columns = {name: self._read(name, start, stop) for name in self._names()}
+        if self.transform is None:
+            features = np.concatenate(
+                [columns[x].astype(np.float32) for x in self.features], axis=1
+            )
+        else:
+            features = np.asarray(self.transform(columns), dtype=np.float32)
+        target = None
+        if self.target:
+            target = columns[self.target].astype(np.float32).reshape(-1)
+        return features, target
+
+    def _chunks(self, rng):
+        starts = np.arange(0, self.rows, self.chunk_rows)
+        if self.shuffle:
+            rng.shuffle(starts)
+        return [(start, min(start + self.chunk_rows, self.rows)) for start in starts]
+
+    def _read_ahead(self, chunks):
+        # Keeps at most `prefetch` chunk reads in flight across the reader threads.
+        with ThreadPoolExecutor(max_workers=self.readers) as executor:
+            pending = []
+            for start, stop in chunks:
+                pending.append(executor.submit(self.read_chunk, start, stop))
+                if len(pending) >= self.prefetch:
+                    yield pending.pop(0).result()
+            for future in pending:
+                yield future.result()
+
+    def _batches(self, rng):
+        buffer_x, buffer_y, buffered = [], [], 0
+        for features, target in self._read_ahead(self._chunks(rng)):
+            buffer_x.append(features)
+            buffer_y.append(target)
+            buffered += len(features)
+            if buffered < self.shuffle_buffer:
+                continue
+            x, y = self._merge(buffer_x, buffer_y, rng)
+            # Emit whole batches and carry the remainder into the next buffer.
+            keep = len(x) - len(x) % self.batch_size
+            yield from self._split(x[:keep], None if y is None else y[:keep])
+            buffer_x, buffer_y = [x[keep:]], [None if y is None else y[keep:]]
+            buffered = len(x) - keep
+        if buffered:
+            x, y = self._merge(buffer_x, buffer_y, rng)
+            if self.drop_last:
+                keep = len(x) - len(x) % self.batch_size
+                x, y = x[:keep], None if y is None else y[:keep]
+            yield from self._split(x, y)
+
+    def _merge(self, buffer_x, buffer_y, rng):
+        x = np.concatenate(buffer_x)
+        y = None if self.target is None else np.concatenate(buffer_y)
+        if self.shuffle:
+            order = rng.permutation(len(x))
+            x = x[order]
+            y = None if y is None else y[order]
+        return x, y
+
+    def _split(self, x, y):
+        for start in range(0, len(x), self.batch_size):
+            stop = start + self.batch_size
+            yield x[start:stop] if y is None else (x[start:stop], y[start:stop])
+
+    @staticmethod
+    def _put(output, item, stop_event):
+        while not stop_event.is_set():
+            try:
+                output.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _produce(self, output, stop_event, rng):
+        try:
+            for batch in self._batches(rng):
+                if not self._put(output, batch, stop_event):
+                    return
+        except Exception as e:
+            logging.exception("Feature loader failed")
+            self._put(output, e, stop_event)
+            return
+        self._put(output, _END, stop_event)
+
+    def __iter__(self):
+        rng = np.random.default_rng([self.seed, self.epoch])
+        self.epoch += 1
+        output = queue.Queue(maxsize=self.prefetch)
+        stop_event = threading.Event()
+        producer = threading.Thread(
+            target=self._produce, args=(output, stop_event, rng), daemon=True
+        )
+        producer.start()
+        try:
+            while True:
+                batch = output.get()
+                if batch is _END:
+                    break
+                if isinstance(batch, Exception):
+                    raise batch
+                yield batch
+        finally:
+            stop_event.set()
+            producer.join()
+
+    def as_tf_dataset(self):
+        import tensorflow as tf
+
+        width = sum(
+            int(np.prod(self.manifests[x]["shape"][1:])) for x in self.features
+        )
+        if self.transform is not None:
+            width = self.read_chunk(0, min(1, self.rows))[0].shape[1]
+        spec_x = tf.TensorSpec(shape=(None, width), dtype=tf.float32)
+        if self.target is None:
+            signature = spec_x
+        else:
+            signature = (spec_x, tf.TensorSpec(shape=(None,), dtype=tf.float32))
+        return tf.data.Dataset.from_generator(
+            self.__iter__, output_signature=signature
+        ).prefetch(tf.data.AUTOTUNE)
@@ -1,161 +1,539 @@
-import glob
+import tempfile
+import contextlib
 import numpy as np
-import pickle
 import os
+import pandas
+import pyarrow.parquet
 import logging
 import argparse
 
-from sklearn.pipeline import Pipeline
-
+import src.cache as cache
+import src.instrumentation as instrumentation
 import src.load_data
 import src.features.utils as ml_utils
+import src.features.split as split
+import src.features.store as store
+import src.features.routes as routes
+from src.parallel import atomic_path, atomic_write_parquet, run_parallel
+from src.features.service import LOCATION_TYPES, load_region_indexes, region_labels
+from src.features.coordinates import (
+    decode_region_codes,
+    encode_region_labels,
+    get_hexagon,
+    load_region_dictionary,
+    lookup_region_codes,
+    region_code_columns,
+)
+
+
+BASE_TRANSFORMERS = {
+    "fare": ml_utils.FareAmount,
+    "passenger_count": ml_utils.PassengerCount,
+    "bounding_box": ml_utils.GeographicalBoundingBox,
+    "coordinates": ml_utils.GeographicalCoordinates,
+    "timestamp_week": ml_utils.Timestamp_Week,
+    "primary_key": ml_utils.PrimaryKey,
+}
+SECONDS_PER_HOUR = 3600
+COMPACT_ENCODINGS = {"timestamp_week": {"divisor": SECONDS_PER_HOUR}}
+
+
+def scan_base_features(files, names=None):
+    if names is None:
+        names = list(BASE_TRANSFORMERS)
+    arrays = ml_utils.fused_transform([BASE_TRANSFORMERS[n]() for n in names], files)
+    return dict(zip(names, arrays))
+
+
+def _get_distance(base):
+    if "distance" not in base:
+        base["distance"] = ml_utils.GeographicalKernel().transform(base["coordinates"])
+    return base["distance"]
+
+
+def outliers_from_base(base):
+    is_good = (
+        (base["bounding_box"] == 1)
+        & (_get_distance(base) > 0)
+        & (_get_distance(base) < 100)
+        & (base["fare"] > 0)
+        & (base["fare"] < 100)
+    )
+    return is_good.reshape(-1)
 
 
 def detect_outliers(files):
-    good_cordinates = ml_utils.GeographicalBoundingBox().transform(files)
-    distance = Pipeline(
-        [
-            ("coordinates", ml_utils.GeographicalCoordinates()),
-            ("distance", ml_utils.GeographicalDistance()),
-        ]
-    ).transform(files)
-    fare = ml_utils.FareAmount().transform(files)
-    is_good = (
-        (good_cordinates == 1)
-        & (distance > 0)
-        & (distance < 100)
-        & (fare > 0)
-        & (fare < 100)
+    base = scan_base_features(files, ["bounding_box", "coordinates", "fare"])
+    return outliers_from_base(base)
+
+
+def train_test_split_index(is_good, fraction_train, keys, seed=0):
+    return split.assign_status(keys, is_good, fraction_train, seed).astype(int)
+
+
+def make_train_test_split(base, compact=False, split_params=None):
+    split_params = dict(split.DEFAULT_SPLIT, **(split_params or {}))
+    status = train_test_split_index(
+        outliers_from_base(base),
+        split_params["fraction_train"],
+        base["primary_key"],
+        split_params["seed"],
     )
-    return is_good.reshape(-1)
+    return status.astype(np.int8) if compact else status
 
 
-def train_test_split_index(is_good, fraction_train):
-    size = len(is_good)
-    status = (np.random.random(size) > fraction_train).astype(int)
-    status[(is_good == 0)] = 2
-    return status
+def make_fold(base, compact=False, split_params=None):
+    split_params = dict(split.DEFAULT_SPLIT, **(split_params or {}))
+    fold = split.assign_fold(
+        base["primary_key"], split_params["folds"], split_params["seed"]
+    )
+    return fold if compact else fold.astype(int)
+
 
+def make_coordinates(base, compact=False):
+    return base["coordinates"] if compact else base["coordinates"].astype(float)
 
-def make_coordinates(files):
-    coordinates = ml_utils.GeographicalCoordinates().transform(files)
-    return coordinates.astype(float)
 
+def make_distance(base, compact=False):
+    distance = _get_distance(base).reshape(-1, 1)
+    return distance if compact else distance.astype(float)
 
-def make_distance(files):
-    distance = Pipeline(
-        [
-            ("coordinates", ml_utils.GeographicalCoordinates()),
-            ("distance", ml_utils.GeographicalDistance()),
-        ]
-    ).transform(files)
-    return distance.astype(float).reshape(-1, 1)
 
+def make_fare(base, compact=False):
+    fare = base["fare"].reshape(-1, 1)
+    return fare if compact else fare.astype(float)
 
-def make_fare(files):
-    fare = ml_utils.FareAmount().transform(files)
-    return fare.astype(float).reshape(-1, 1)
 
+def make_timestamp_week(base, compact=False):
+    if compact:
+        # Whole seconds within the week; decoded with the "divisor" encoding.
+        seconds = np.rint(base["timestamp_week"] * SECONDS_PER_HOUR)
+        return seconds.astype(np.int32).reshape(-1, 1)
+    return base["timestamp_week"].astype(float).reshape(-1, 1)
 
-def make_timestamp_week(files):
-    timestamp = ml_utils.Timestamp_Week().transform(files)
-    return timestamp.astype(float).reshape(-1, 1)
 
+def make_passenger_count(base, compact=False):
+    return base["passenger_count"]
 
-def make_passenger_count(files):
-    passenger_count = ml_utils.PassengerCount().transform(files)
-    return passenger_count
 
+def make_primary_key(base, compact=False):
+    return base["primary_key"]
 
-def make_primary_key(files):
-    primary_key = ml_utils.PrimaryKey().transform(files)
-    return primary_key
 
+def make_geometry(base, out):
+    kernel = ml_utils.GeographicalKernel()
+    kernel.transform_all(base.get("coordinates"), base.get("timestamp_week"), out=out)
+    return out
 
-def make_location(files):
-    location = ml_utils.Location().transform(files)
-    return location
 
+def make_location(files, region_id=None, compact=False, labels=None):
+    location = ml_utils.Location(region_id).transform(files)
+    if labels is not None and not compact:
+        location = np.stack(
+            [decode_region_codes(x, labels).values for x in location.T], axis=1
+        )
+        return location, None
+    if labels is None and compact:
+        labels = np.unique(pandas.Series(location.ravel()).dropna().values)
+        location = np.stack([encode_region_labels(x, labels) for x in location.T], axis=1)
+    return location, labels
 
-def generate_features(folder_save):
+
+def make_route_stats(folder_save, fls, compact=False, split_params=None):
+    # Reads back fare, distance and the split from the store, which share the
+    # key-sorted row order of the hexagon files.
+    hexagons = ml_utils.Location("hexagon").transform(fls)
+    columns = {
+        name: store.load_feature(folder_save, name, decode=True).reshape(-1)
+        for name in ["fare", "distance", "train_test_split", "fold"]
+    }
+    if len(hexagons) != len(columns["fare"]):
+        raise ValueError("Hexagon files are not aligned with {}".format(folder_save))
+    arr, index = routes.route_features_oof(
+        hexagons[:, 0],
+        hexagons[:, 1],
+        columns["fare"],
+        columns["distance"],
+        columns["train_test_split"],
+        columns["fold"],
+    )
+    return (arr if compact else arr.astype(float)), index
+
+
+def _existing_refined_files(stage):
+    fls = src.load_data.get_refined_files(stage, src.load_data.get_data_files()[0])
+    return fls if fls and all(os.path.exists(x) for x in fls) else []
+
+
+def get_hexagon_files():
+    return _existing_refined_files("hexagon")
+
+
+def _location_labels(fls, region_id):
+    # Compact refined files hold int16 codes next to a JSON dictionary.
+    column = "pickup_" + region_id
+    compact = {column in region_code_columns(fl) for fl in fls}
+    if len(compact) > 1:
+        raise ValueError("Mixed compact and wide files for {}".format(region_id))
+    if compact == {True}:
+        return load_region_dictionary(os.path.dirname(fls[0]), region_id)
+    return None
+
+
+SPLIT_FEATURES = ("train_test_split", "fold")
+LOCATION_FEATURES = {"borough": "BoroName", "state_assembly": "AssemDist"}
+RASTER_SUFFIX = "_raster"
+ROUTE_FEATURE = "route_stats"
+ROUTE_INDEX = "route_index.npz"
+
+
+def get_location_files(name, region_id, raster=False):
+    # The raster is an approximation of the exact hexagon lookup used online,
+    # so its features are opt-in and saved under their own names. The exact
+    # files come from the same location type as the service.
+    if raster:
+        fls = _existing_refined_files("regions")
+        if fls and ("pickup_" + region_id) in pyarrow.parquet.read_schema(fls[0]).names:
+            return fls, region_id
+        return [], region_id
+    return _existing_refined_files(LOCATION_TYPES[name]), None
+
+
+FEATURE_PLAN = [
+    (
+        make_train_test_split,
+        "train_test_split",
+        ["bounding_box", "coordinates", "fare", "primary_key"],
+    ),
+    (make_fold, "fold", ["primary_key"]),
+    (make_fare, "fare", ["fare"]),
+    (make_passenger_count, "passenger_count", ["passenger_count"]),
+    (make_coordinates, "coordinates", ["coordinates"]),
+    (make_distance, "distance", ["coordinates"]),
+    (make_timestamp_week, "timestamp_week", ["timestamp_week"]),
+    (make_primary_key, "primary_key", ["primary_key"]),
+    (make_geometry, "manhattan_distance", ["coordinates"]),
+    (make_geometry, "bearing", ["coordinates"]),
+    (make_geometry, "mercator", ["coordinates"]),
+    (make_geometry, "fourier_day", ["timestamp_week"]),
+]
+
+
+def _feature_params(name, func, compact=False, split_params=None):
+    params = {
+        "stage": "feature",
+        "name": name,
+        "compact": compact,
+        "code": cache.code_hash(func, ml_utils),
+    }
+    if name in SPLIT_FEATURES + (ROUTE_FEATURE,):
+        params["split"] = dict(split.DEFAULT_SPLIT, **(split_params or {}))
+    return params
+
+
+def _write_geometry(folder_save, base, plan, files, compact, split_params):
+    # All geometric features come from one chunked pass written straight into
+    # memory-mapped .npy files, so they add no full-length arrays in memory.
+    names = [name for func, name, _ in plan if func is make_geometry]
+    if not names:
+        return
+    rows = len(next(iter(base.values())))
+    widths = ml_utils.GeographicalKernel().widths()
+    with contextlib.ExitStack() as stack:
+        out = {
+            name: stack.enter_context(
+                store.feature_writer(
+                    folder_save,
+                    name,
+                    (rows, widths[name]),
+                    np.float32,
+                    source=store.source_hash(files),
+                )
+            )
+            for name in names
+        }
+        with instrumentation.stage("feature_derive", rows=rows) as record:
+            record["feature"] = ",".join(names)
+            make_geometry(base, out)
+    for name in names:
+        cache.record(
+            os.path.join(folder_save, f"{name}.npy"),
+            files,
+            _feature_params(name, make_geometry, compact, split_params),
+        )
+
+
+def generate_features(folder_save, compact=False, split_params=None, raster=False):
     files = {}
     files["train"], files["test"] = src.load_data.get_data_files()
-    plan = [
-        (
-            lambda *args: train_test_split_index(detect_outliers(*args), 0.75),
-            "train_test_split",
-        ),
-        (make_fare, "fare"),
-        (make_passenger_count, "passenger_count"),
-        (make_coordinates, "coordinates"),
-        (make_distance, "distance"),
-        (make_timestamp_week, "timestamp_week"),
-        (make_primary_key, "primary_key"),
-    ]
     folder_save = os.path.join(folder_save, "full")
     os.makedirs(folder_save, exist_ok=True)
-    for func, name in plan:
-        fl_save = os.path.join(folder_save, f"{name}.pickle")
-        if os.path.exists(fl_save):
+
+    plan = [
+        (func, name, needed)
+        for func, name, needed in FEATURE_PLAN
+        if not cache.skip_if_fresh(
+            os.path.join(folder_save, f"{name}.npy"),
+            files["train"],
+            _feature_params(name, func, compact, split_params),
+        )
+    ]
+    if plan:
+        source = store.source_hash(files["train"])
+        needed = [n for n in BASE_TRANSFORMERS if any(n in x[2] for x in plan)]
+        base = scan_base_features(files["train"], needed)
+        _write_geometry(folder_save, base, plan, files["train"], compact, split_params)
+        for func, name, _ in plan:
+            if func is make_geometry:
+                continue
+            with instrumentation.stage("feature_derive") as record:
+                record["feature"] = name
+                if name in SPLIT_FEATURES:
+                    arr = func(base, compact, split_params)
+                else:
+                    arr = func(base, compact)
+            with instrumentation.stage("feature_write", rows=len(arr)) as record:
+                record["feature"] = name
+                store.save_feature(
+                    folder_save,
+                    name,
+                    arr,
+                    source=source,
+                    encoding=COMPACT_ENCODINGS.get(name) if compact else None,
+                )
+            cache.record(
+                os.path.join(folder_save, f"{name}.npy"),
+                files["train"],
+                _feature_params(name, func, compact, split_params),
+            )
+        del base
+
+    locations = [
+        (name, region_id, from_raster)
+        for from_raster in ([False, True] if raster else [False])
+        for name, region_id in LOCATION_FEATURES.items()
+    ]
+    for location_name, region_id, from_raster in locations:
+        fls, column = get_location_files(location_name, region_id, from_raster)
+        if not fls:
+            logging.warning("No refined files for {}".format(location_name))
             continue
-        arr = func(files["train"])
-        if len(arr.shape) == 1:
-            arr = arr.reshape(-1, 1)
-        with open(fl_save, "wb") as f:
-            pickle.dump(arr, f)
-        logging.info(f"Saved {fl_save}")
-
-    folder_refined = os.path.join(src.load_data.DATA_FOLDER, "refined")
-    for name in ["borough", "state_assembly"]:
-        fl_save = os.path.join(folder_save, f"{name}.pickle")
-        if os.path.exists(fl_save):
+        name = location_name + (RASTER_SUFFIX if from_raster else "")
+        fl_save = os.path.join(folder_save, f"{name}.npy")
+        params = dict(_feature_params(name, make_location, compact), region_id=column)
+        if cache.skip_if_fresh(fl_save, fls, params):
             continue
-        fls = glob.glob(os.path.join(folder_refined, f"{name}*train*.parquet"))
-        arr = make_location(fls)
-        if len(arr.shape) == 1:
-            arr = arr.reshape(-1, 1)
-        with open(fl_save, "wb") as f:
-            pickle.dump(arr, f)
-        logging.info(f"Saved {fl_save}")
+        labels = _location_labels(fls, region_id)
+        arr, labels = make_location(fls, column, compact, labels)
+        encoding = None
+        if compact:
+            encoding = {"dictionary": np.asarray(labels).tolist()}
+        with instrumentation.stage("feature_write", rows=len(arr)) as record:
+            record["feature"] = name
+            store.save_feature(
+                folder_save, name, arr, source=store.source_hash(fls), encoding=encoding
+            )
+        cache.record(fl_save, fls, params)
+
+    fl_save = os.path.join(folder_save, f"{ROUTE_FEATURE}.npy")
+    fls = get_hexagon_files()
+    params = dict(
+        _feature_params(ROUTE_FEATURE, make_route_stats, compact, split_params),
+        code=cache.code_hash(make_route_stats, routes, ml_utils),
+        resolutions=list(routes.ROUTE_RESOLUTIONS),
+        min_count=routes.ROUTE_MIN_COUNT,
+    )
+    if fls and not cache.skip_if_fresh(fl_save, fls + files["train"], params):
+        with instrumentation.stage("feature_derive") as record:
+            record["feature"] = ROUTE_FEATURE
+            arr, index = make_route_stats(folder_save, fls, compact, split_params)
+        fl_index = os.path.join(folder_save, ROUTE_INDEX)
+        with atomic_path(fl_index) as fl_tmp:
+            routes.save_route_index(index, fl_tmp)
+        logging.info("Saved {}".format(fl_index))
+        with instrumentation.stage("feature_write", rows=len(arr)) as record:
+            record["feature"] = ROUTE_FEATURE
+            store.save_feature(
+                folder_save, ROUTE_FEATURE, arr, source=store.source_hash(fls)
+            )
+        cache.record(fl_save, fls + files["train"], params)
+
+
+SCORE_BATCH_ROWS = 131072
+SCORE_SKIP = SPLIT_FEATURES + ("fare",)
+_SCORING_STATE = {}
+
+
+def load_model(uri):
+    # Pickled sklearn pipelines, or models logged with mlflow.sklearn.log_model
+    # as in the notebook; both take a feature folder in predict.
+    if os.path.isfile(uri):
+        import joblib
+
+        return joblib.load(uri)
+    import mlflow.sklearn
+
+    return mlflow.sklearn.load_model(uri)
+
+
+def _scoring_state(model_uri, route_index):
+    # Loaded once per process and reused for every batch it scores.
+    key = (model_uri, route_index)
+    if key not in _SCORING_STATE:
+        _SCORING_STATE[key] = (
+            load_model(model_uri),
+            load_region_indexes(),
+            None if route_index is None else routes.load_route_index(route_index),
+        )
+    return _SCORING_STATE[key]
+
+
+def featurize_frame(df, indexes, route_index=None, resolution=15):
+    base = {
+        name: transformer().transform_single(df[transformer.columns].copy()).values
+        for name, transformer in BASE_TRANSFORMERS.items()
+        if set(transformer.columns) <= set(df.columns)
+    }
+    plan = [
+        (func, name)
+        for func, name, needed in FEATURE_PLAN
+        if name not in SCORE_SKIP and set(needed) <= set(base)
+    ]
+    features = {}
+    geometry = [name for func, name in plan if func is make_geometry]
+    names = geometry + (["distance"] if "coordinates" in base else [])
+    if names:
+        # One kernel pass per batch, distance included.
+        out = ml_utils.GeographicalKernel().allocate(len(df), names)
+        make_geometry(base, out)
+        if "distance" in out:
+            base["distance"] = out.pop("distance")
+        features.update(out)
+    for func, name in plan:
+        if func is not make_geometry:
+            features[name] = func(base)
+    # Hexagon, region and route stages, vectorized over the whole batch.
+    df_hexagon = df[[x for x in df.columns if x.endswith(("_latitude", "_longitude"))]]
+    df_hexagon = df_hexagon.copy()
+    for prefix in ["pickup", "dropoff"]:
+        df_hexagon = get_hexagon(df_hexagon, prefix, resolution)
+    hexagons = {x: df_hexagon[x + "_hexagon"].values for x in ["pickup", "dropoff"]}
+    for name, index in indexes.items():
+        codes = [lookup_region_codes(index, x) for x in hexagons.values()]
+        features[name] = np.stack([region_labels(index, x) for x in codes], axis=1)
+    if route_index is not None:
+        features[ROUTE_FEATURE] = routes.lookup_routes(
+            route_index, hexagons["pickup"], hexagons["dropoff"]
+        ).astype(float)
+    return features
+
+
+def _read_rows(fl, start, stop):
+    parquet_file = pyarrow.parquet.ParquetFile(fl)
+    metadata = parquet_file.metadata
+    offsets = np.cumsum(
+        [0] + [metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)]
+    )
+    groups = [
+        i
+        for i in range(metadata.num_row_groups)
+        if offsets[i] < stop and offsets[i + 1] > start
+    ]
+    table = parquet_file.read_row_groups(groups)
+    return table.slice(start - offsets[groups[0]], stop - start).to_pandas()
+
+
+def _score_batch(fl, start, stop, model_uri, route_index, fl_save):
+    model, indexes, routes_loaded = _scoring_state(model_uri, route_index)
+    with instrumentation.stage("parquet_read", fl, rows=stop - start):
+        df = _read_rows(fl, start, stop)
+    with instrumentation.stage("score_features", fl, rows=len(df)):
+        features = featurize_frame(df, indexes, routes_loaded)
+    with tempfile.TemporaryDirectory() as folder_tmp:
+        for name, arr in features.items():
+            store.save_feature(folder_tmp, name, arr)
+        with instrumentation.stage("score_predict", fl, rows=len(df)):
+            prediction = np.asarray(model.predict(folder_tmp), dtype=np.float32)
+    df_out = pandas.DataFrame(
+        {"key": df["key"].values, "fare_amount": prediction.reshape(-1)}
+    )
+    atomic_write_parquet(df_out, fl_save)
+    return fl_save
+
+
+def score(
+    files,
+    model_uri,
+    fl_output,
+    batch_rows=SCORE_BATCH_ROWS,
+    workers=1,
+    route_index=None,
+):
+    folder_output = os.path.dirname(os.path.abspath(fl_output))
+    os.makedirs(folder_output, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=folder_output) as folder_tmp:
+        tasks = []
+        for position, fl in enumerate(files):
+            rows = pyarrow.parquet.ParquetFile(fl).metadata.num_rows
+            for start in range(0, rows, batch_rows):
+                fl_save = os.path.join(folder_tmp, f"{position:05d}_{start:012d}.parquet")
+                stop = min(start + batch_rows, rows)
+                tasks.append((fl, start, stop, model_uri, route_index, fl_save))
+        partials = run_parallel(_score_batch, tasks, workers)
+        # Partials are appended in input order, so memory stays at one batch.
+        with atomic_path(fl_output) as fl_tmp:
+            if fl_output.endswith(".csv"):
+                for i, fl in enumerate(partials):
+                    pandas.read_parquet(fl).to_csv(
+                        fl_tmp, mode="a", header=i == 0, index=False
+                    )
+            else:
+                schema = pyarrow.schema(
+                    [("key", pyarrow.string()), ("fare_amount", pyarrow.float32())]
+                )
+                with pyarrow.parquet.ParquetWriter(fl_tmp, schema) as writer:
+                    for fl in partials:
+                        writer.write_table(
+                            pyarrow.parquet.read_table(fl).cast(schema)
+                        )
+    logging.info("Saved {}".format(fl_output))
+    return fl_output
 
 
 def simplify(folder_data, examples):
-    fls = glob.glob(os.path.join(folder_data, "full", "*.pickle"))
+    folder_full = os.path.join(folder_data, "full")
     folder_save = os.path.join(folder_data, "small")
     os.makedirs(folder_save, exist_ok=True)
-    for fl in fls:
-        with open(fl, "rb") as f:
-            arr = pickle.load(f)
-        _, base = os.path.split(fl)
-        fl_save = os.path.join(folder_save, base)
-        with open(fl_save, "wb") as f:
-            pickle.dump(arr[:examples, :], f)
-        logging.info(f"Saved {fl_save}")
+    for name in store.list_features(folder_full):
+        store.save_view(folder_save, name, folder_full, stop=examples)
 
 
-def train_test_split(folder_data, examples):
+def train_test_split(folder_data, examples, split_params=None):
+    folder_full = os.path.join(folder_data, "full")
     folder_save_train = os.path.join(folder_data, "train")
     folder_save_test = os.path.join(folder_data, "test")
     os.makedirs(folder_save_train, exist_ok=True)
     os.makedirs(folder_save_test, exist_ok=True)
 
-    with open(os.path.join(folder_data, "full", "train_test_split.pickle"), "rb") as f:
-        status = pickle.load(f).reshape(-1)[:examples]
-    fls = glob.glob(os.path.join(folder_data, "full", "*.pickle"))
-    for fl in fls:
-        with open(fl, "rb") as f:
-            arr = pickle.load(f)[:examples, :]
-        
-        _, base = os.path.split(fl)
-        fl_save = os.path.join(folder_save_train, base)
-        with open(fl_save, "wb") as f:
-            pickle.dump(arr[status==0, :], f)
-        logging.info(f"Saved {fl_save}")
-        fl_save = os.path.join(folder_save_test, base)
-        with open(fl_save, "wb") as f:
-            pickle.dump(arr[status==1, :], f)
-        logging.info(f"Saved {fl_save}")
-
+    status = store.load_feature(folder_full, "train_test_split")[:examples]
+    status = status.reshape(-1)
+    if split_params:
+        # Re-split from the keys without rescanning; outliers stay outliers.
+        split_params = dict(split.DEFAULT_SPLIT, **split_params)
+        keys = store.load_feature(folder_full, "primary_key")[:examples]
+        status = split.assign_status(
+            keys.reshape(-1),
+            status != split.SPLIT_OUTLIER,
+            split_params["fraction_train"],
+            split_params["seed"],
+        )
+    index_train = np.flatnonzero(status == split.SPLIT_TRAIN)
+    index_test = np.flatnonzero(status == split.SPLIT_TEST)
+    store.save_index(folder_save_train, index_train)
+    store.save_index(folder_save_test, index_test)
+    for name in store.list_features(folder_full):
+        store.save_view(folder_save_train, name, folder_full, index=index_train)
+        store.save_view(folder_save_test, name, folder_full, index=index_test)
 
 
 if __name__ == "__main__":
@@ -163,13 +541,46 @@ if __name__ == "__main__":
     parser.add_argument("--folder")
     parser.add_argument("--script")
     parser.add_argument("--examples", type=int, default=0)
+    parser.add_argument("--compact", action="store_true")
+    parser.add_argument("--raster", action="store_true")
+    parser.add_argument("--fraction_train", type=float, default=None)
+    parser.add_argument("--folds", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--input", nargs="*", default=None)
+    parser.add_argument("--model", default=None)
+    parser.add_argument("--output", default=None)
+    parser.add_argument("--route_index", default=None)
+    parser.add_argument("--batch_rows", type=int, default=SCORE_BATCH_ROWS)
+    parser.add_argument("--workers", type=int, default=1)
+    instrumentation.add_arguments(parser)
     args = parser.parse_args()
 
     logging.basicConfig(level=logging.INFO)
+    instrumentation.configure_from_args(args)
+    split_params = {
+        key: getattr(args, key)
+        for key in split.DEFAULT_SPLIT
+        if getattr(args, key) is not None
+    }
 
     if args.script == "generate":
-        generate_features(args.folder)
+        generate_features(
+            args.folder,
+            compact=args.compact,
+            split_params=split_params,
+            raster=args.raster,
+        )
     if args.script == "simplify":
         simplify(args.folder, args.examples)
     if args.script == "train_test_split":
-        train_test_split(args.folder, args.examples)
+        train_test_split(args.folder, args.examples, split_params)
+    if args.script == "score":
+        score(
+            args.input or src.load_data.get_data_files()[1],
+            args.model,
+            args.output,
+            batch_rows=args.batch_rows,
+            workers=args.workers,
+            route_index=args.route_index,
+        )
+    instrumentation.finish(args)
@@ -0,0 +1,182 @@
+import os
+import functools
+import logging
+import argparse
+import itertools
+import numpy as np
+import pandas
+
+import src.cache as cache
+import src.instrumentation as instrumentation
+from src.load_data import DATA_FOLDER, get_data_files
+from src.parallel import atomic_path, atomic_write_parquet, run_parallel
+from src.features.coordinates import (
+    REGION_CODE_DTYPE,
+    REGION_IDS,
+    decode_region_codes,
+    geo_to_hexagon_array,
+    get_region_index,
+    lookup_region_codes,
+    region_codes_metadata,
+    save_region_dictionary,
+)
+
+# Same box as ml_utils.GeographicalBoundingBox.
+BOUNDS_LAT = (40, 42)
+BOUNDS_LON = (-75, -72)
+DEFAULT_LAYERS = [
+    "borough_shoreline",
+    "state_assembly_shoreline",
+    "state_senate_shoreline",
+    "national_congress_shoreline",
+]
+RASTER_FILE = os.path.join(DATA_FOLDER, "external", "regions_raster.npz")
+
+
+def build_raster(layers, step=0.001, block_rows=100):
+    n_lat = int(round((BOUNDS_LAT[1] - BOUNDS_LAT[0]) / step))
+    n_lon = int(round((BOUNDS_LON[1] - BOUNDS_LON[0]) / step))
+    indexes = [get_region_index(x, REGION_IDS[x]) for x in layers]
+    raster = np.full((len(layers), n_lat, n_lon), -1, dtype=np.int16)
+    lon = BOUNDS_LON[0] + (np.arange(n_lon) + 0.5) * step
+    for start in range(0, n_lat, block_rows):
+        stop = min(start + block_rows, n_lat)
+        lat = BOUNDS_LAT[0] + (np.arange(start, stop) + 0.5) * step
+        grid_lat, grid_lon = np.meshgrid(lat, lon, indexing="ij")
+        hexagons = geo_to_hexagon_array(grid_lat.ravel(), grid_lon.ravel(), 15)
+        for position, index in enumerate(indexes):
+            codes = lookup_region_codes(index, hexagons)
+            raster[position, start:stop, :] = codes.reshape(stop - start, n_lon)
+        logging.info("Rasterized rows {}-{} of {}".format(start, stop, n_lat))
+    return {
+        "raster": raster,
+        "layers": np.array(layers),
+        "region_ids": np.array([REGION_IDS[x] for x in layers]),
+        "labels": [index["labels"] for index in indexes],
+        "step": step,
+    }
+
+
+def save_raster(raster, fl_save):
+    arrays = {k: v for k, v in raster.items() if k != "labels"}
+    for position, labels in enumerate(raster["labels"]):
+        if labels.dtype == object:
+            labels = labels.astype(str)
+        arrays["labels_{}".format(position)] = labels
+    with atomic_path(fl_save) as fl_tmp:
+        with open(fl_tmp, "wb") as f:
+            np.savez(f, **arrays)
+    logging.info("Saved {}".format(fl_save))
+
+
+@functools.lru_cache(maxsize=2)
+def load_raster(fl=RASTER_FILE):
+    with np.load(fl) as data:
+        raster = {key: data[key] for key in data.files if not key.startswith("labels")}
+        raster["labels"] = [
+            data["labels_{}".format(x)] for x in range(len(raster["layers"]))
+        ]
+    raster["step"] = float(raster["step"])
+    return raster
+
+
+def raster_lookup(raster, latitude, longitude):
+    step = raster["step"]
+    _, n_lat, n_lon = raster["raster"].shape
+    row = np.floor((np.asarray(latitude, dtype=np.float64) - BOUNDS_LAT[0]) / step)
+    col = np.floor((np.asarray(longitude, dtype=np.float64) - BOUNDS_LON[0]) / step)
+    inside = (row >= 0) & (row < n_lat) & (col >= 0) & (col < n_lon)
+    flat = np.where(inside, row * n_lon + col, 0).astype(np.int64)
+    codes = raster["raster"].reshape(len(raster["layers"]), -1)[:, flat]
+    codes[:, ~inside] = -1
+    return codes
+
+
+def find_regions(df, raster, compact=False):
+    df_out = df[[]].copy()
+    for prefix in ["pickup", "dropoff"]:
+        codes = raster_lookup(
+            raster, df[prefix + "_latitude"].values, df[prefix + "_longitude"].values
+        )
+        for position, region_id in enumerate(raster["region_ids"]):
+            if compact:
+                values = codes[position].astype(REGION_CODE_DTYPE)
+            else:
+                values = decode_region_codes(
+                    codes[position], raster["labels"][position], index=df.index
+                )
+            df_out[prefix + "_" + str(region_id)] = values
+    return df_out
+
+
+def _process_regions_file(fl, folder_output, fl_raster, compact=False):
+    _, base = os.path.split(fl)
+    fl_save = os.path.join(folder_output, "regions_" + base)
+    params = {
+        "stage": "regions",
+        "compact": compact,
+        "code": cache.code_hash(raster_lookup, find_regions, region_codes_metadata),
+    }
+    if cache.skip_if_fresh(fl_save, [fl, fl_raster], params):
+        return fl_save
+    columns = [
+        "pickup_latitude",
+        "pickup_longitude",
+        "dropoff_latitude",
+        "dropoff_longitude",
+    ]
+    with instrumentation.stage("parquet_read", fl) as record:
+        df = pandas.read_parquet(fl, columns=columns)
+        record["rows"] = len(df)
+    with instrumentation.stage("region_merge", fl, rows=len(df)):
+        df = find_regions(df, load_raster(fl_raster), compact)
+    metadata = region_codes_metadata(df.columns if compact else [])
+    with instrumentation.stage("parquet_write", fl_save, rows=len(df)):
+        atomic_write_parquet(df, fl_save, metadata)
+    cache.record(fl_save, [fl, fl_raster], params)
+    logging.info("Saved {}".format(fl_save))
+    return fl_save
+
+
+def process_regions(folder_output, fl_raster=RASTER_FILE, workers=1, compact=False):
+    if compact:
+        raster = load_raster(fl_raster)
+        for region_id, labels in zip(raster["region_ids"], raster["labels"]):
+            save_region_dictionary(folder_output, str(region_id), labels)
+    tasks = [
+        (fl, folder_output, fl_raster, compact)
+        for fl in itertools.chain(*get_data_files())
+    ]
+    return run_parallel(_process_regions_file, tasks, workers)
+
+
+def available_layers(layers=DEFAULT_LAYERS):
+    folder = os.path.join(DATA_FOLDER, "external")
+    return [x for x in layers if os.path.exists(os.path.join(folder, x + ".parquet"))]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--script")
+    parser.add_argument("--folder", default=None)
+    parser.add_argument("--layers", default=None)
+    parser.add_argument("--step", type=float, default=0.001)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--compact", action="store_true")
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    instrumentation.configure_from_args(args)
+
+    if args.script == "build":
+        if args.layers is None:
+            layers = available_layers()
+        else:
+            layers = [x.strip() for x in args.layers.split(",")]
+        with instrumentation.stage("raster_build"):
+            raster = build_raster(layers, args.step)
+        save_raster(raster, RASTER_FILE)
+    if args.script == "regions":
+        process_regions(args.folder, workers=args.workers, compact=args.compact)
+    instrumentation.finish(args)
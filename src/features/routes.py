@@ -0,0 +1,127 @@
+import numpy as np
+
+from src.features.split import SPLIT_TRAIN
+
+ROUTE_RESOLUTIONS = (8, 7, 6)
+ROUTE_MIN_COUNT = 20
+ROUTE_COLUMNS = ["fare_mean", "distance_mean", "count", "resolution"]
+H3_DIGIT_BITS = 3
+H3_BASE_CELL_BITS = 7
+H3_MAX_RESOLUTION = 15
+
+
+def _packed_bits(resolution):
+    return H3_BASE_CELL_BITS + H3_DIGIT_BITS * resolution
+
+
+def pack_cells(cells, resolution):
+    # Base cell plus the first `resolution` digits, i.e. the parent cell
+    # without its mode/resolution header: 31 bits at resolution 8.
+    cells = np.asarray(cells, dtype=np.uint64)
+    shift = np.uint64(H3_DIGIT_BITS * (H3_MAX_RESOLUTION - resolution))
+    mask = np.uint64((1 << _packed_bits(resolution)) - 1)
+    return (cells >> shift) & mask
+
+
+def pack_pairs(pickup, dropoff, resolution):
+    bits = np.uint64(_packed_bits(resolution))
+    return (pack_cells(pickup, resolution) << bits) | pack_cells(dropoff, resolution)
+
+
+def build_route_index(pickup, dropoff, fare, distance, resolutions=ROUTE_RESOLUTIONS):
+    valid = (np.asarray(pickup) > 0) & (np.asarray(dropoff) > 0)
+    valid &= np.isfinite(fare) & np.isfinite(distance)
+    pickup, dropoff = pickup[valid], dropoff[valid]
+    fare = np.asarray(fare, dtype=np.float64)[valid]
+    distance = np.asarray(distance, dtype=np.float64)[valid]
+    index = {
+        "resolutions": np.array(resolutions),
+        "global": np.array(
+            [
+                fare.mean() if len(fare) else np.nan,
+                distance.mean() if len(distance) else np.nan,
+            ]
+        ),
+    }
+    for resolution in resolutions:
+        keys, inverse, count = np.unique(
+            pack_pairs(pickup, dropoff, resolution),
+            return_inverse=True,
+            return_counts=True,
+        )
+        inverse = inverse.reshape(-1)
+        index[f"keys_{resolution}"] = keys
+        index[f"count_{resolution}"] = count.astype(np.int64)
+        index[f"fare_{resolution}"] = np.bincount(inverse, fare) / count
+        index[f"distance_{resolution}"] = np.bincount(inverse, distance) / count
+    return index
+
+
+def save_route_index(index, fl_save):
+    with open(fl_save, "wb") as f:
+        np.savez(f, **index)
+
+
+def load_route_index(fl):
+    with np.load(fl) as data:
+        return {key: data[key] for key in data.files}
+
+
+def lookup_routes(index, pickup, dropoff, min_count=ROUTE_MIN_COUNT):
+    pickup = np.asarray(pickup, dtype=np.uint64)
+    dropoff = np.asarray(dropoff, dtype=np.uint64)
+    output = np.full((len(pickup), len(ROUTE_COLUMNS)), np.nan, dtype=np.float32)
+    output[:, 0:2] = index["global"]
+    output[:, 2] = 0
+    output[:, 3] = -1
+    pending = np.flatnonzero((pickup > 0) & (dropoff > 0))
+    # Finest resolution first; sparse pairs fall back to coarser parents.
+    for resolution in sorted(index["resolutions"], reverse=True):
+        keys = index[f"keys_{resolution}"]
+        if len(pending) == 0 or len(keys) == 0:
+            continue
+        packed = pack_pairs(pickup[pending], dropoff[pending], int(resolution))
+        position = np.minimum(np.searchsorted(keys, packed), len(keys) - 1)
+        count = index[f"count_{resolution}"][position]
+        found = (keys[position] == packed) & (count >= min_count)
+        rows, position = pending[found], position[found]
+        output[rows, 0] = index[f"fare_{resolution}"][position]
+        output[rows, 1] = index[f"distance_{resolution}"][position]
+        output[rows, 2] = count[found]
+        output[rows, 3] = resolution
+        pending = pending[~found]
+    return output
+
+
+def route_features_oof(
+    pickup,
+    dropoff,
+    fare,
+    distance,
+    status,
+    fold,
+    resolutions=ROUTE_RESOLUTIONS,
+    min_count=ROUTE_MIN_COUNT,
+):
+    # Training rows are encoded with statistics from the other folds only, so
+    # a ride never sees its own fare; other rows use all training rows.
+    is_train = np.asarray(status).reshape(-1) == SPLIT_TRAIN
+    fold = np.asarray(fold).reshape(-1)
+    output = np.empty((len(pickup), len(ROUTE_COLUMNS)), dtype=np.float32)
+    for value in np.unique(fold[is_train]):
+        fit = is_train & (fold != value)
+        index = build_route_index(
+            pickup[fit], dropoff[fit], fare[fit], distance[fit], resolutions
+        )
+        rows = np.flatnonzero(is_train & (fold == value))
+        output[rows] = lookup_routes(index, pickup[rows], dropoff[rows], min_count)
+    index = build_route_index(
+        pickup[is_train],
+        dropoff[is_train],
+        fare[is_train],
+        distance[is_train],
+        resolutions,
+    )
+    rows = np.flatnonzero(~is_train)
+    output[rows] = lookup_routes(index, pickup[rows], dropoff[rows], min_count)
+    return output, index
@@ -0,0 +1,300 @@
+import json
+import asyncio
+import logging
+import argparse
+import functools
+import numpy as np
+import pandas
+
+import src.features.utils as ml_utils
+import src.features.routes as routes
+from src.features.coordinates import (
+    REGION_IDS,
+    geo_to_hexagon_array,
+    get_region_index,
+    h3_to_parent_array,
+    lookup_region_codes,
+)
+
+RIDE_FIELDS = [
+    "pickup_datetime",
+    "pickup_latitude",
+    "pickup_longitude",
+    "dropoff_latitude",
+    "dropoff_longitude",
+    "passenger_count",
+]
+COORDINATE_FIELDS = RIDE_FIELDS[1:5]
+LOCATION_TYPES = {
+    "borough": "borough_shoreline",
+    "state_assembly": "state_assembly_shoreline",
+}
+NANOSECONDS_PER_DAY = 86400 * 10**9
+GEOMETRY_FEATURES = [
+    "distance",
+    "manhattan_distance",
+    "bearing",
+    "mercator",
+    "fourier_day",
+]
+
+
+def load_region_indexes(location_types=None):
+    if location_types is None:
+        location_types = LOCATION_TYPES
+    return {
+        name: get_region_index(location_type, REGION_IDS[location_type])
+        for name, location_type in location_types.items()
+    }
+
+
+def region_labels(index, codes):
+    values = index["labels"].astype(object)[np.maximum(codes, 0)]
+    values[codes < 0] = np.nan
+    return values
+
+
+class FeatureService:
+    def __init__(
+        self, location_types=None, resolution=15, cache_size=2**20, route_index=None
+    ):
+        self.resolution = resolution
+        self.cache_size = cache_size
+        if isinstance(route_index, str):
+            route_index = routes.load_route_index(route_index)
+        self.route_index = route_index
+        self.indexes = load_region_indexes(location_types)
+        # Keyed by the parent at the finest index resolution: every hexagon under
+        # a cached parent lies inside that parent's region.
+        self.cache_resolutions = {
+            name: min(int(index["resolutions"].max(initial=0)), resolution)
+            for name, index in self.indexes.items()
+        }
+        self._code_cache = {name: {} for name in self.indexes}
+
+    def _region_codes(self, name, hexagons):
+        index, cache = self.indexes[name], self._code_cache[name]
+        hexagons = np.asarray(hexagons, dtype=np.uint64)
+        codes = np.full(len(hexagons), -1, dtype=int)
+        valid = np.flatnonzero(hexagons > 0)
+        parents = h3_to_parent_array(hexagons[valid], self.cache_resolutions[name])
+        unique, inverse = np.unique(parents, return_inverse=True)
+        unique_codes = np.array([cache.get(int(x), -1) for x in unique], dtype=int)
+        missing = unique_codes < 0
+        if missing.any():
+            parent_codes = lookup_region_codes(index, unique[missing])
+            if len(cache) + len(parent_codes) > self.cache_size:
+                cache.clear()
+            cache.update(
+                (int(x), int(c)) for x, c in zip(unique[missing], parent_codes) if c >= 0
+            )
+            unique_codes[missing] = parent_codes
+        codes[valid] = unique_codes[inverse.reshape(-1)]
+        # Parents on a region boundary (or outside every region) are resolved per
+        # hexagon in one vectorized call.
+        pending = valid[codes[valid] < 0]
+        codes[pending] = lookup_region_codes(index, hexagons[pending])
+        return codes
+
+    @staticmethod
+    def _as_arrays(rides):
+        if isinstance(rides, pandas.DataFrame):
+            rides = {x: rides[x].values for x in RIDE_FIELDS}
+        elif isinstance(rides, dict):
+            rides = {x: [rides[x]] for x in RIDE_FIELDS}
+        else:
+            rides = {x: [ride[x] for ride in rides] for x in RIDE_FIELDS}
+        timestamps = rides["pickup_datetime"]
+        if not np.issubdtype(np.asarray(timestamps).dtype, np.datetime64):
+            timestamps = [str(x)[:19] for x in timestamps]
+        return {
+            "pickup_datetime": np.asarray(timestamps, dtype="datetime64[ns]"),
+            "coordinates": np.stack(
+                [np.asarray(rides[x], dtype=np.float32) for x in COORDINATE_FIELDS],
+                axis=1,
+            ),
+            "passenger_count": np.asarray(rides["passenger_count"], dtype=np.int32),
+        }
+
+    def features(self, rides):
+        rides = self._as_arrays(rides)
+        coordinates = rides["coordinates"]
+        valid = (
+            (coordinates[:, [0, 2]] > -90).all(axis=1)
+            & (coordinates[:, [0, 2]] < 90).all(axis=1)
+            & (coordinates[:, [1, 3]] > -180).all(axis=1)
+            & (coordinates[:, [1, 3]] < 180).all(axis=1)
+        )
+        coordinates[~valid] = np.nan
+        # Same arithmetic as ml_utils.Timestamp_Week, on datetime64 integers.
+        nanoseconds = rides["pickup_datetime"].astype(np.int64)
+        weekday = (nanoseconds // NANOSECONDS_PER_DAY + 4) % 7
+        time_in_week = weekday * 24 + (
+            (nanoseconds % NANOSECONDS_PER_DAY) / 1e9 / 3600
+        )
+        # One kernel pass gives the same geometric features as FEATURE_PLAN.
+        geometry = ml_utils.GeographicalKernel().transform_all(
+            coordinates, time_in_week.reshape(-1, 1), names=GEOMETRY_FEATURES
+        )
+        output = {
+            "passenger_count": rides["passenger_count"].reshape(-1, 1),
+            "coordinates": coordinates.astype(float),
+            "distance": geometry.pop("distance").astype(float),
+            "timestamp_week": time_in_week.astype(float).reshape(-1, 1),
+        }
+        output.update({name: arr.astype(float) for name, arr in geometry.items()})
+        hexagons = {}
+        for prefix, columns in [("pickup", [0, 1]), ("dropoff", [2, 3])]:
+            hexagons[prefix] = np.zeros(len(coordinates), dtype=np.uint64)
+            hexagons[prefix][valid] = geo_to_hexagon_array(
+                coordinates[valid, columns[0]],
+                coordinates[valid, columns[1]],
+                self.resolution,
+            )
+        for name, index in self.indexes.items():
+            output[name] = np.stack(
+                [
+                    region_labels(index, self._region_codes(name, hexagons[prefix]))
+                    for prefix in ["pickup", "dropoff"]
+                ],
+                axis=1,
+            )
+        if self.route_index is not None:
+            output["route_stats"] = routes.lookup_routes(
+                self.route_index, hexagons["pickup"], hexagons["dropoff"]
+            ).astype(float)
+        return output
+
+
+def _to_json_value(value):
+    if isinstance(value, (float, np.floating)) and np.isnan(value):
+        return None
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+class MicroBatcher:
+    def __init__(self, service, max_batch=256, max_delay=0.002):
+        self.service = service
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.queue = asyncio.Queue()
+
+    async def submit(self, rides):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((rides, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_delay
+            size = len(batch[0][0])
+            while size < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                batch.append(item)
+                size += len(item[0])
+            rides = [ride for item in batch for ride in item[0]]
+            try:
+                features = self.service.features(rides)
+            except Exception:
+                # Score requests one by one so a malformed ride only fails
+                # its own request.
+                for item_rides, future in batch:
+                    try:
+                        features = self.service.features(item_rides)
+                        future.set_result(self._rows(features, 0, len(item_rides)))
+                    except Exception as e:
+                        future.set_exception(e)
+                continue
+            start = 0
+            for item_rides, future in batch:
+                stop = start + len(item_rides)
+                future.set_result(self._rows(features, start, stop))
+                start = stop
+
+    @staticmethod
+    def _rows(features, start, stop):
+        return [
+            {
+                name: [_to_json_value(x) for x in arr[row]]
+                for name, arr in features.items()
+            }
+            for row in range(start, stop)
+        ]
+
+
+async def _handle(batcher, reader, writer):
+    try:
+        request_line = await reader.readline()
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            key, _, value = line.decode("latin1").partition(":")
+            headers[key.strip().lower()] = value.strip()
+        body = await reader.readexactly(int(headers.get("content-length", 0)))
+        if not request_line.startswith(b"POST"):
+            status, payload = "405 Method Not Allowed", {"error": "use POST"}
+        else:
+            rides = json.loads(body)
+            single = isinstance(rides, dict)
+            result = await batcher.submit([rides] if single else rides)
+            status, payload = "200 OK", result[0] if single else result
+    except Exception as e:
+        logging.exception("Request failed")
+        status, payload = "400 Bad Request", {"error": str(e)}
+    content = json.dumps(payload).encode("utf8")
+    writer.write(
+        "HTTP/1.1 {}\r\nContent-Type: application/json\r\n"
+        "Content-Length: {}\r\nConnection: close\r\n\r\n".format(status, len(content))
+        .encode("latin1")
+        + content
+    )
+    await writer.drain()
+    writer.close()
+
+
+async def serve(service, host="127.0.0.1", port=8080, max_batch=256, max_delay=0.002):
+    batcher = MicroBatcher(service, max_batch, max_delay)
+    worker = asyncio.ensure_future(batcher.run())
+    server = await asyncio.start_server(
+        functools.partial(_handle, batcher), host, port
+    )
+    logging.info("Serving features on {}:{}".format(host, port))
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        worker.cancel()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--max_batch", type=int, default=256)
+    parser.add_argument("--max_delay", type=float, default=0.002)
+    parser.add_argument("--route_index", default=None)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    asyncio.run(
+        serve(
+            FeatureService(route_index=args.route_index),
+            args.host,
+            args.port,
+            args.max_batch,
+            args.max_delay,
+        )
+    )
@@ -0,0 +1,39 @@
+import numpy as np
+
+SPLIT_TRAIN, SPLIT_TEST, SPLIT_OUTLIER = 0, 1, 2
+DEFAULT_SPLIT = {"fraction_train": 0.75, "folds": 5, "seed": 0}
+STREAM_SPLIT, STREAM_FOLD = 0, 1
+
+
+def splitmix64(x):
+    x = np.asarray(x, dtype=np.uint64)
+    with np.errstate(over="ignore"):
+        x = x + np.uint64(0x9E3779B97F4A7C15)
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def key_hash(keys, seed=0, stream=STREAM_SPLIT):
+    # Keys are the uint64 md5 row index, so the same ride always gets the
+    # same hash regardless of file, chunk or row order.
+    salt = splitmix64(np.uint64(seed) * np.uint64(2) + np.uint64(stream))
+    return splitmix64(np.asarray(keys, dtype=np.uint64) ^ salt)
+
+
+def key_uniform(keys, seed=0, stream=STREAM_SPLIT):
+    return (key_hash(keys, seed, stream) >> np.uint64(11)) * (1.0 / (1 << 53))
+
+
+def assign_split(keys, fraction_train=0.75, seed=0):
+    return (key_uniform(keys, seed) >= fraction_train).astype(np.int8)
+
+
+def assign_fold(keys, folds=5, seed=0):
+    return (key_hash(keys, seed, STREAM_FOLD) % np.uint64(folds)).astype(np.int8)
+
+
+def assign_status(keys, is_good, fraction_train=0.75, seed=0):
+    status = assign_split(keys, fraction_train, seed)
+    status[np.asarray(is_good).reshape(-1) == 0] = SPLIT_OUTLIER
+    return status
@@ -0,0 +1,155 @@
+import os
+import glob
+import json
+import hashlib
+import logging
+import contextlib
+import numpy as np
+
+from src.cache import MANIFEST_SUFFIX
+from src.parallel import atomic_path
+from src.features.coordinates import decode_region_codes
+
+INDEX_NAME = "index.npy"
+
+
+def source_hash(path_iterable):
+    digest = hashlib.sha1()
+    for p in sorted(path_iterable):
+        stat = os.stat(p)
+        digest.update(
+            "{}:{}:{}\n".format(os.path.basename(p), stat.st_size, stat.st_mtime_ns)
+            .encode("utf8")
+        )
+    return digest.hexdigest()
+
+
+def _manifest_path(folder, name):
+    return os.path.join(folder, f"{name}.json")
+
+
+def _write_manifest(folder, name, manifest):
+    with atomic_path(_manifest_path(folder, name)) as fl_tmp:
+        with open(fl_tmp, "w") as f:
+            json.dump(manifest, f, indent=2)
+
+
+def read_manifest(folder, name):
+    with open(_manifest_path(folder, name)) as f:
+        return json.load(f)
+
+
+def has_feature(folder, name):
+    return os.path.exists(_manifest_path(folder, name))
+
+
+def list_features(folder):
+    fls = glob.glob(os.path.join(folder, "*.json"))
+    fls = [fl for fl in fls if not fl.endswith(MANIFEST_SUFFIX)]
+    return sorted(os.path.splitext(os.path.basename(fl))[0] for fl in fls)
+
+
+def save_feature(folder, name, arr, source=None, encoding=None):
+    if len(arr.shape) == 1:
+        arr = arr.reshape(-1, 1)
+    fl_save = os.path.join(folder, f"{name}.npy")
+    with atomic_path(fl_save) as fl_tmp:
+        with open(fl_tmp, "wb") as f:
+            np.save(f, arr, allow_pickle=arr.dtype == object)
+    manifest = {
+        "name": name,
+        "dtype": str(arr.dtype),
+        "shape": list(arr.shape),
+        "source_hash": source,
+    }
+    if encoding:
+        manifest["encoding"] = encoding
+    _write_manifest(folder, name, manifest)
+    logging.info(f"Saved {fl_save}")
+
+
+@contextlib.contextmanager
+def feature_writer(folder, name, shape, dtype, source=None, encoding=None):
+    # Yields a writable memory-mapped array; the file and manifest appear on exit.
+    fl_save = os.path.join(folder, f"{name}.npy")
+    with atomic_path(fl_save) as fl_tmp:
+        arr = np.lib.format.open_memmap(fl_tmp, mode="w+", dtype=dtype, shape=shape)
+        yield arr
+        arr.flush()
+        del arr
+    manifest = {
+        "name": name,
+        "dtype": str(np.dtype(dtype)),
+        "shape": list(shape),
+        "source_hash": source,
+    }
+    if encoding:
+        manifest["encoding"] = encoding
+    _write_manifest(folder, name, manifest)
+    logging.info(f"Saved {fl_save}")
+
+
+def save_view(folder, name, parent, stop=None, index=None):
+    parent_manifest = read_manifest(parent, name)
+    manifest = dict(parent_manifest, parent=os.path.relpath(parent, folder))
+    if stop is not None:
+        manifest["stop"] = int(stop)
+        manifest["shape"][0] = min(parent_manifest["shape"][0], int(stop))
+    if index is not None:
+        manifest["index"] = INDEX_NAME
+        manifest["shape"][0] = int(len(index))
+    _write_manifest(folder, name, manifest)
+    logging.info("Saved {}".format(_manifest_path(folder, name)))
+
+
+def save_index(folder, index):
+    fl_save = os.path.join(folder, INDEX_NAME)
+    with atomic_path(fl_save) as fl_tmp:
+        with open(fl_tmp, "wb") as f:
+            np.save(f, np.asarray(index, dtype=np.int64))
+    logging.info(f"Saved {fl_save}")
+
+
+def decode_feature(arr, encoding):
+    if "divisor" in encoding:
+        arr = arr / encoding["divisor"]
+    if "dictionary" in encoding:
+        labels = np.array(encoding["dictionary"])
+        arr = np.stack(
+            [decode_region_codes(x, labels).values for x in np.asarray(arr).T], axis=1
+        )
+    return arr
+
+
+def take_rows(folder, name, rows):
+    # Reads only the requested rows, following views down to the .npy file.
+    manifest = read_manifest(folder, name)
+    if "parent" in manifest:
+        parent = os.path.normpath(os.path.join(folder, manifest["parent"]))
+        if "index" in manifest:
+            index = np.load(os.path.join(folder, manifest["index"]), mmap_mode="r")
+            rows = index[rows]
+        return take_rows(parent, name, rows)
+    fl = os.path.join(folder, f"{name}.npy")
+    if manifest["dtype"] == "object":
+        return np.load(fl, allow_pickle=True)[rows]
+    return np.asarray(np.load(fl, mmap_mode="r")[rows])
+
+
+def load_feature(folder, name, mmap=True, decode=False):
+    manifest = read_manifest(folder, name)
+    if decode and "encoding" in manifest:
+        return decode_feature(load_feature(folder, name, mmap), manifest["encoding"])
+    if "parent" in manifest:
+        parent = os.path.normpath(os.path.join(folder, manifest["parent"]))
+        arr = load_feature(parent, name, mmap=mmap)
+        if "stop" in manifest:
+            arr = arr[: manifest["stop"]]
+        if "index" in manifest:
+            index = np.load(os.path.join(folder, manifest["index"]), mmap_mode="r")
+            arr = arr[index]
+        return arr
+    fl = os.path.join(folder, f"{name}.npy")
+    if manifest["dtype"] == "object":
+        return np.load(fl, allow_pickle=True)
+    return np.load(fl, mmap_mode="r" if mmap else None)
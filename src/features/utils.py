@@ -1,7 +1,18 @@
+import os
+import glob
+import hashlib
+import itertools
+import collections
 import pandas
 import numpy as np
+import pyarrow.parquet
 from sklearn.base import BaseEstimator, TransformerMixin
 
+import src.features.store as store
+import src.instrumentation as instrumentation
+from src.load_data import filter_frame, matching_row_groups
+from src.parallel import atomic_path
+
 
 class Transformer(BaseEstimator, TransformerMixin):
     def __init__(self, *args, **kwargs):
@@ -10,29 +21,206 @@ class Transformer(BaseEstimator, TransformerMixin):
     def fit(self, *args, **kwargs):
         return self
 
+    def partial_fit(self, *args, **kwargs):
+        return self
+
     def fit_transform(self, *args, **kwargs):
         return self.transform(*args, **kwargs)
 
+    def transform_iter(self, batch_iterable, *args, **kwargs):
+        for batch in batch_iterable:
+            yield self.transform(batch, *args, **kwargs)
 
-class FareAmount(Transformer):
-    def transform(self, path_iterable, *args, **kwargs):
-        df_out = pandas.concat(
-            (pandas.read_parquet(p)[["fare_amount"]] for p in path_iterable)
-        )
-        as_array = df_out.sort_index().values
-        return as_array
+
+def iter_parquet(path_iterable, columns=None, batch_rows=None, filters=None):
+    for p in path_iterable:
+        if batch_rows is None:
+            yield pandas.read_parquet(p, columns=columns, filters=filters)
+            continue
+        parquet_file = pyarrow.parquet.ParquetFile(p)
+        row_groups = matching_row_groups(parquet_file, filters)
+        if not row_groups:
+            continue
+        read_columns = columns
+        if columns is not None:
+            metadata = parquet_file.schema_arrow.pandas_metadata or {}
+            index_columns = metadata.get("index_columns", [])
+            read_columns = list(columns) + [
+                x for x in index_columns if isinstance(x, str)
+            ]
+            read_columns += [
+                x for x, _, _ in filters or [] if x not in read_columns
+            ]
+        for batch in parquet_file.iter_batches(
+            batch_size=batch_rows, row_groups=row_groups, columns=read_columns
+        ):
+            df = filter_frame(batch.to_pandas(), filters)
+            yield df if columns is None else df[list(columns)]
+
+
+def fit_iter(estimator, batch_iterable, sample_rows=1000000, random_state=0):
+    if hasattr(estimator, "partial_fit"):
+        for batch in batch_iterable:
+            estimator.partial_fit(batch)
+        return estimator
+    # Estimators without partial_fit (RobustScaler, PolynomialFeatures, Pipeline)
+    # are fitted on a uniform bottom-k sample drawn with bounded memory.
+    rng = np.random.default_rng(random_state)
+    sample, sample_keys = None, None
+    for batch in batch_iterable:
+        keys = rng.random(len(batch))
+        if sample is not None:
+            batch = np.concatenate([sample, batch])
+            keys = np.concatenate([sample_keys, keys])
+        if len(keys) > sample_rows:
+            keep = np.argpartition(keys, sample_rows)[:sample_rows]
+            batch, keys = batch[keep], keys[keep]
+        sample, sample_keys = batch, keys
+    return estimator.fit(sample)
+
+
+ROW_ORDER_CACHE_SIZE = 2
+_ROW_ORDER_CACHE = collections.OrderedDict()
+
+
+def _row_order_prefix(paths):
+    # Names the file set regardless of its contents, so a stale order for the
+    # same files can be found and replaced when they change.
+    names = "\n".join(sorted(os.path.basename(p) for p in paths))
+    return hashlib.sha1(names.encode("utf8")).hexdigest()[:12]
+
+
+def _compute_row_order(paths):
+    keys = [
+        pandas.read_parquet(p, columns=[]).index.values.astype(np.uint64) for p in paths
+    ]
+    offsets = np.cumsum([0] + [len(x) for x in keys])
+    order = np.argsort(np.concatenate(keys), kind="stable")
+    rank = np.empty(len(order), dtype=np.uint32)
+    rank[order] = np.arange(len(order), dtype=np.uint32)
+    return rank, offsets
+
+
+def get_row_order(path_iterable):
+    paths = list(path_iterable)
+    key = store.source_hash(paths)
+    if key in _ROW_ORDER_CACHE:
+        _ROW_ORDER_CACHE.move_to_end(key)
+        return _ROW_ORDER_CACHE[key]
+    folder = os.path.dirname(paths[0]) if paths else "."
+    prefix = os.path.join(folder, ".row_order_{}_".format(_row_order_prefix(paths)))
+    fl_order = prefix + key + ".npz"
+    if os.path.exists(fl_order):
+        with np.load(fl_order) as data:
+            rank, offsets = data["rank"], data["offsets"]
+    else:
+        rank, offsets = _compute_row_order(paths)
+        with atomic_path(fl_order) as fl_tmp:
+            with open(fl_tmp, "wb") as f:
+                np.savez(f, rank=rank, offsets=offsets)
+        for fl in glob.glob(prefix + "*.npz"):
+            if fl != fl_order:
+                os.remove(fl)
+    _ROW_ORDER_CACHE[key] = (rank, offsets)
+    while len(_ROW_ORDER_CACHE) > ROW_ORDER_CACHE_SIZE:
+        _ROW_ORDER_CACHE.popitem(last=False)
+    return rank, offsets
 
 
-class PassengerCount(Transformer):
+class OrderedOutput:
+    def __init__(self, path_iterable):
+        self.paths = list(path_iterable)
+        self.rank, self.offsets = get_row_order(self.paths)
+        self.array = None
+
+    def write(self, position, values):
+        values = np.asarray(values)
+        start, stop = self.offsets[position], self.offsets[position + 1]
+        rows = self.rank[start:stop]
+        if self.array is None:
+            shape = (self.offsets[-1],) + values.shape[1:]
+            self.array = np.empty(shape, dtype=values.dtype)
+        elif np.result_type(self.array.dtype, values.dtype) != self.array.dtype:
+            self.array = self.array.astype(np.result_type(self.array.dtype, values.dtype))
+        self.array[rows] = values
+
+
+def _read_instrumented(p, columns):
+    with instrumentation.stage("parquet_read", p) as record:
+        df = pandas.read_parquet(p, columns=columns)
+        record["rows"] = len(df)
+    return df
+
+
+class FileTransformer(Transformer):
+    columns = None
+
+    @staticmethod
+    def transform_single(df):
+        return df
+
+    def transform_iter(
+        self, path_iterable, batch_rows=None, filters=None, *args, **kwargs
+    ):
+        for df in iter_parquet(path_iterable, self.columns, batch_rows, filters):
+            yield self.transform_single(df).values
+
     def transform(self, path_iterable, *args, **kwargs):
-        df_out = pandas.concat(
-            (pandas.read_parquet(p)[["passenger_count"]] for p in path_iterable)
-        )
-        as_array = df_out.sort_index().values
-        return as_array
+        output = OrderedOutput(path_iterable)
+        for position, p in enumerate(output.paths):
+            df = _read_instrumented(p, self.columns)
+            with instrumentation.stage("feature_transform", p, rows=len(df)) as record:
+                record["transformer"] = type(self).__name__
+                output.write(position, self.transform_single(df).values)
+        return output.array
+
+
+def fused_transform(transformers, path_iterable):
+    if any(t.columns is None for t in transformers):
+        columns = None
+    else:
+        columns = sorted(set(itertools.chain(*(t.columns for t in transformers))))
+    outputs = [OrderedOutput(path_iterable) for _ in transformers]
+    for position, p in enumerate(outputs[0].paths if outputs else []):
+        df = _read_instrumented(p, columns)
+        for output, transformer in zip(outputs, transformers):
+            frame = df if transformer.columns is None else df[transformer.columns]
+            with instrumentation.stage("feature_transform", p, rows=len(df)) as record:
+                record["transformer"] = type(transformer).__name__
+                output.write(position, transformer.transform_single(frame.copy()).values)
+    return [output.array for output in outputs]
+
+
+def fused_transform_iter(transformers, path_iterable, batch_rows=None, filters=None):
+    if any(t.columns is None for t in transformers):
+        columns = None
+    else:
+        columns = sorted(set(itertools.chain(*(t.columns for t in transformers))))
+    for df in iter_parquet(path_iterable, columns, batch_rows, filters):
+        yield [
+            transformer.transform_single(
+                (df if transformer.columns is None else df[transformer.columns]).copy()
+            ).values
+            for transformer in transformers
+        ]
 
 
-class GeographicalBoundingBox(Transformer):
+class FareAmount(FileTransformer):
+    columns = ["fare_amount"]
+
+
+class PassengerCount(FileTransformer):
+    columns = ["passenger_count"]
+
+
+class GeographicalBoundingBox(FileTransformer):
+    columns = [
+        "pickup_latitude",
+        "pickup_longitude",
+        "dropoff_latitude",
+        "dropoff_longitude",
+    ]
+
     @staticmethod
     def transform_single(df):
         bounds_lat = (40, 42)
@@ -50,15 +238,15 @@ class GeographicalBoundingBox(Transformer):
         df["is_correct"] = flter.astype(float)
         return df[["is_correct"]]
 
-    def transform(self, path_iterable, *args, **kwargs):
-        df_out = pandas.concat(
-            (self.transform_single(pandas.read_parquet(p)) for p in path_iterable)
-        )
-        as_array = df_out.sort_index().values
-        return as_array
 
+class GeographicalCoordinates(FileTransformer):
+    columns = [
+        "pickup_latitude",
+        "pickup_longitude",
+        "dropoff_latitude",
+        "dropoff_longitude",
+    ]
 
-class GeographicalCoordinates(Transformer):
     @staticmethod
     def transform_single(df):
         columns = [
@@ -82,13 +270,6 @@ class GeographicalCoordinates(Transformer):
         df.loc[~flter, columns] = None
         return df[columns]
 
-    def transform(self, path_iterable, *args, **kwargs):
-        df_out = pandas.concat(
-            (self.transform_single(pandas.read_parquet(p)) for p in path_iterable)
-        )
-        as_array = df_out.sort_index().values
-        return as_array
-
 
 class GeographicalDistance(Transformer):
     def transform(self, as_array, *args, **kwargs):
@@ -110,7 +291,134 @@ class GeographicalDistance(Transformer):
         return distance.reshape(-1, 1)
 
 
-class Timestamp_Week(Transformer):
+class GeographicalKernel(GeographicalDistance):
+    # Same street-grid rotation as commonly used for Manhattan (~29 degrees).
+    grid_angle = 29.0
+    earth_radius = 6371
+
+    def __init__(self, chunk_rows=65536, period=24, max_freq=4, *args, **kwargs):
+        self.chunk_rows = chunk_rows
+        self.period = period
+        self.max_freq = max_freq
+
+    def widths(self):
+        return {
+            "distance": 1,
+            "manhattan_distance": 1,
+            "bearing": 1,
+            "mercator": 4,
+            "fourier_day": 2 * self.max_freq,
+        }
+
+    def allocate(self, rows, names):
+        widths = self.widths()
+        return {name: np.empty((rows, widths[name]), dtype=np.float32) for name in names}
+
+    def transform(self, as_array, *args, **kwargs):
+        return self.transform_all(as_array, names=["distance"])["distance"]
+
+    def transform_all(self, coordinates=None, time_in_week=None, names=None, out=None):
+        if names is None:
+            names = list(out) if out is not None else list(self.widths())
+        if out is None:
+            rows = len(coordinates) if coordinates is not None else len(time_in_week)
+            out = self.allocate(rows, names)
+        geometric = [x for x in names if x != "fourier_day"]
+        if geometric:
+            self._geometry_chunks(coordinates, {x: out[x] for x in geometric})
+        if "fourier_day" in names:
+            self._fourier_chunks(time_in_week, out["fourier_day"])
+        return out
+
+    def _geometry_chunks(self, coordinates, out):
+        deg_to_rad = np.float32(np.pi / 180)
+        chunk = min(self.chunk_rows, max(len(coordinates), 1))
+        # Scratch buffers are reused for every chunk; outputs are written in place.
+        lat1, lon1, lat2, lon2, cos1, cos2, a, b, c, d = np.empty((10, chunk), np.float32)
+        angle = np.deg2rad(self.grid_angle)
+        cos_grid, sin_grid = np.float32(np.cos(angle)), np.float32(np.sin(angle))
+        for start in range(0, len(coordinates), chunk):
+            stop = min(start + chunk, len(coordinates))
+            n, rows = stop - start, slice(start, stop)
+            for position, buffer in enumerate([lat1, lon1, lat2, lon2]):
+                np.multiply(coordinates[rows, position], deg_to_rad, out=buffer[:n])
+            np.cos(lat1[:n], out=cos1[:n])
+            np.cos(lat2[:n], out=cos2[:n])
+            if "distance" in out:
+                # Same operation order as GeographicalDistance, so values match.
+                for diff, first, second in [(a, lat1, lat2), (b, lon1, lon2)]:
+                    np.subtract(first[:n], second[:n], out=diff[:n])
+                    np.divide(diff[:n], 2, out=diff[:n])
+                    np.sin(diff[:n], out=diff[:n])
+                    np.power(diff[:n], 2, out=diff[:n])
+                np.multiply(cos1[:n], cos2[:n], out=c[:n])
+                np.multiply(c[:n], b[:n], out=b[:n])
+                np.add(a[:n], b[:n], out=a[:n])
+                np.sqrt(a[:n], out=a[:n])
+                np.arcsin(a[:n], out=a[:n])
+                np.multiply(a[:n], 2 * self.earth_radius, out=out["distance"][rows, 0])
+            if "manhattan_distance" in out:
+                # Local east (a) and north (b) offsets, rotated onto the street grid.
+                np.add(lat1[:n], lat2[:n], out=a[:n])
+                np.multiply(a[:n], 0.5, out=a[:n])
+                np.cos(a[:n], out=a[:n])
+                np.subtract(lon2[:n], lon1[:n], out=b[:n])
+                np.multiply(a[:n], b[:n], out=a[:n])
+                np.subtract(lat2[:n], lat1[:n], out=b[:n])
+                np.multiply(a[:n], cos_grid, out=c[:n])
+                np.multiply(b[:n], sin_grid, out=d[:n])
+                np.add(c[:n], d[:n], out=c[:n])
+                np.abs(c[:n], out=c[:n])
+                np.multiply(b[:n], cos_grid, out=d[:n])
+                np.multiply(a[:n], sin_grid, out=a[:n])
+                np.subtract(d[:n], a[:n], out=d[:n])
+                np.abs(d[:n], out=d[:n])
+                np.add(c[:n], d[:n], out=c[:n])
+                np.multiply(
+                    c[:n], self.earth_radius, out=out["manhattan_distance"][rows, 0]
+                )
+            if "bearing" in out:
+                np.subtract(lon2[:n], lon1[:n], out=b[:n])
+                np.sin(b[:n], out=c[:n])
+                np.multiply(c[:n], cos2[:n], out=c[:n])
+                np.cos(b[:n], out=b[:n])
+                np.multiply(b[:n], cos2[:n], out=b[:n])
+                np.sin(lat1[:n], out=a[:n])
+                np.multiply(b[:n], a[:n], out=b[:n])
+                np.sin(lat2[:n], out=d[:n])
+                np.multiply(d[:n], cos1[:n], out=d[:n])
+                np.subtract(d[:n], b[:n], out=d[:n])
+                np.arctan2(c[:n], d[:n], out=out["bearing"][rows, 0])
+            if "mercator" in out:
+                mercator = out["mercator"]
+                for position, (lat, lon) in enumerate([(lat1, lon1), (lat2, lon2)]):
+                    mercator[rows, 2 * position] = lon[:n]
+                    np.multiply(lat[:n], 0.5, out=a[:n])
+                    np.add(a[:n], np.float32(np.pi / 4), out=a[:n])
+                    np.tan(a[:n], out=a[:n])
+                    np.log(a[:n], out=mercator[rows, 2 * position + 1])
+        return out
+
+    def _fourier_chunks(self, time_in_week, out):
+        time_in_week = time_in_week.reshape(-1)
+        chunk = min(self.chunk_rows, max(len(time_in_week), 1))
+        angle, scaled = np.empty((2, chunk), np.float32)
+        for start in range(0, len(time_in_week), chunk):
+            stop = min(start + chunk, len(time_in_week))
+            n = stop - start
+            rows = slice(start, stop)
+            np.multiply(time_in_week[rows], 2 * np.pi / self.period, out=angle[:n])
+            # Columns are cos/sin pairs per frequency, as in FourierSeries.
+            for freq in range(1, 1 + self.max_freq):
+                np.multiply(angle[:n], freq, out=scaled[:n])
+                np.cos(scaled[:n], out=out[rows, 2 * freq - 2])
+                np.sin(scaled[:n], out=out[rows, 2 * freq - 1])
+        return out
+
+
+class Timestamp_Week(FileTransformer):
+    columns = ["pickup_datetime"]
+
     @staticmethod
     def transform_single(df):
         day = df["pickup_datetime"].dt.floor("d")
@@ -120,28 +428,16 @@ class Timestamp_Week(Transformer):
         )
         return df[["time_in_week"]]
 
-    def transform(self, path_iterable, *args, **kwargs):
-        df_out = pandas.concat(
-            (self.transform_single(pandas.read_parquet(p)) for p in path_iterable)
-        )
-        as_array = df_out.sort_index().values
-        return as_array
 
+class PrimaryKey(FileTransformer):
+    columns = []
 
-class PrimaryKey(Transformer):
     @staticmethod
     def transform_single(df):
         df_out = df[[]]
         df_out["index"] = df_out.index
         return df_out
 
-    def transform(self, path_iterable, *args, **kwargs):
-        df_out = pandas.concat(
-            (self.transform_single(pandas.read_parquet(p)) for p in path_iterable)
-        )
-        as_array = df_out.sort_index().values
-        return as_array
-
 
 class FourierSeries(Transformer):
     def __init__(self, period, max_freq, *args, **kwargs):
@@ -157,7 +453,12 @@ class FourierSeries(Transformer):
         return np.array(output).T
 
 
-class Location(Transformer):
+class Location(FileTransformer):
+    def __init__(self, region_id=None, *args, **kwargs):
+        self.region_id = region_id
+        if region_id is not None:
+            self.columns = ["pickup_" + region_id, "dropoff_" + region_id]
+
     @staticmethod
     def transform_single(df):
         columns = list(df.columns)
@@ -166,10 +467,3 @@ class Location(Transformer):
         assert len(column_pickup) == 1
         assert len(column_dropoff) == 1
         return df[[column_pickup[0], column_dropoff[0]]]
-
-    def transform(self, path_iterable, df_index=None, *args, **kwargs):
-        df_out = pandas.concat(
-            (self.transform_single(pandas.read_parquet(p)) for p in path_iterable)
-        )
-        as_array = df_out.sort_index().values
-        return as_array
@@ -0,0 +1,136 @@
+import os
+import csv
+import json
+import time
+import cProfile
+import logging
+import resource
+import contextlib
+
+_RECORDS = []
+_CONFIG = {"profile_stage": None, "profile_folder": "."}
+_PROFILE_COUNT = [0]
+
+
+def configure(profile_stage=None, profile_folder="."):
+    _CONFIG["profile_stage"] = profile_stage
+    _CONFIG["profile_folder"] = profile_folder
+
+
+def _read_io():
+    # Characters passed through read/write syscalls, page cache included.
+    try:
+        with open("/proc/self/io") as f:
+            counters = dict(line.split(": ") for line in f.read().splitlines())
+        return int(counters["rchar"]), int(counters["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def rss_mb():
+    # Current resident set size, from /proc/self/statm (in pages).
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def peak_rss_mb():
+    # ru_maxrss is reported in kilobytes on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+@contextlib.contextmanager
+def stage(name, fl=None, rows=None):
+    record = {"stage": name, "file": fl, "rows": rows, "pid": os.getpid()}
+    profiler = None
+    if name == _CONFIG["profile_stage"]:
+        profiler = cProfile.Profile()
+    read_before, written_before = _read_io()
+    rss_before = rss_mb()
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield record
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        record["wall_seconds"] = time.perf_counter() - start_wall
+        record["cpu_seconds"] = time.process_time() - start_cpu
+        read_after, written_after = _read_io()
+        if read_before is not None and read_after is not None:
+            record["bytes_read"] = read_after - read_before
+            record["bytes_written"] = written_after - written_before
+        # ru_maxrss is the high-water mark of the whole process, not of this
+        # stage; rss_mb and rss_delta_mb describe the stage itself.
+        record["process_peak_rss_mb"] = peak_rss_mb()
+        rss_after = rss_mb()
+        if rss_before is not None and rss_after is not None:
+            record["rss_mb"] = rss_after
+            record["rss_delta_mb"] = rss_after - rss_before
+        if record["rows"] is not None and record["wall_seconds"] > 0:
+            record["rows_per_second"] = record["rows"] / record["wall_seconds"]
+        if profiler is not None:
+            _PROFILE_COUNT[0] += 1
+            fl_profile = os.path.join(
+                _CONFIG["profile_folder"],
+                "profile_{}_{}_{}.prof".format(name, os.getpid(), _PROFILE_COUNT[0]),
+            )
+            profiler.dump_stats(fl_profile)
+            record["profile"] = fl_profile
+        _RECORDS.append(record)
+
+
+def drain():
+    records = list(_RECORDS)
+    del _RECORDS[:]
+    return records
+
+
+def extend(records):
+    _RECORDS.extend(records)
+
+
+def call_with_records(config, func, *args):
+    configure(**config)
+    drain()
+    result = func(*args)
+    return result, drain()
+
+
+def get_config():
+    return dict(_CONFIG)
+
+
+def write_report(fl_save):
+    records = list(_RECORDS)
+    if fl_save.endswith(".csv"):
+        fields = []
+        for record in records:
+            fields += [k for k in record if k not in fields]
+        with open(fl_save, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=fields)
+            writer.writeheader()
+            writer.writerows(records)
+    else:
+        with open(fl_save, "w") as f:
+            json.dump({"records": records}, f, indent=2, default=str)
+    logging.info("Saved {}".format(fl_save))
+
+
+def add_arguments(parser):
+    parser.add_argument("--report", default=None)
+    parser.add_argument("--profile", default=None)
+
+
+def configure_from_args(args):
+    folder = os.path.dirname(os.path.abspath(args.report)) if args.report else "."
+    configure(profile_stage=args.profile, profile_folder=folder)
+
+
+def finish(args):
+    if args.report is not None:
+        write_report(args.report)
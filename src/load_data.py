@@ -1,32 +1,54 @@
 import os
+import shutil
+import contextlib
 import pandas
+import datetime
+import operator
 import numpy as np
-from datetime import datetime
 import glob
+import fnmatch
 import logging
 import hashlib
+import argparse
+import itertools
+import zipfile
+import pyarrow
+import pyarrow.parquet
+
+import src.cache as cache
+import src.instrumentation as instrumentation
+from src.parallel import atomic_path, atomic_write_parquet, run_parallel
 
 DATA_FOLDER = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "data"))
+# Month partitions are named e.g. train_2012-03.parquet; rows without a
+# timestamp go to train_0000-00.parquet so the same pattern matches them.
+PARTITION_PATTERN = "{}_????-??.parquet"
+PARTITION_MISSING = "0000-00"
+ROW_GROUP_SIZE = 131072
+FILTER_OPERATORS = {
+    "=": operator.eq,
+    "==": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+}
 
 
-def _parse_data(file_obj, type_, header, limit_lines=None):
-    read_kwargs = {}
-    read_kwargs["header"] = header
-    read_kwargs["dtype"] = {
-        "key": "str",
-        "fare_amount": np.float32,
-        "pickup_datetime": "str",
-        "pickup_longitude": np.float32,
-        "pickup_latitude": np.float32,
-        "dropoff_longitude": np.float32,
-        "dropoff_latitude": np.float32,
-        "passenger_count": np.int32,
-    }
-    if isinstance(limit_lines, int) and (limit_lines > 0):
-        read_kwargs["nrows"] = limit_lines
+RAW_DTYPES = {
+    "key": "str",
+    "fare_amount": np.float32,
+    "pickup_datetime": "str",
+    "pickup_longitude": np.float32,
+    "pickup_latitude": np.float32,
+    "dropoff_longitude": np.float32,
+    "dropoff_latitude": np.float32,
+    "passenger_count": np.int32,
+}
 
-    df = pandas.read_csv(file_obj, **read_kwargs)
 
+def _get_columns(type_):
     columns = [
         "key",
         "pickup_datetime",
@@ -38,50 +60,394 @@ def _parse_data(file_obj, type_, header, limit_lines=None):
     ]
     if type_ == "train":
         columns.insert(1, "fare_amount")
+    return columns
 
-    if header is None:
-        df.columns = columns
-    df = df[columns]
 
-    column_timestamp = "pickup_datetime"
-    if column_timestamp in df.columns:
-        df[column_timestamp] = df[column_timestamp].apply(
-            lambda s: datetime.strptime(s[:19], "%Y-%m-%d %H:%M:%S")
-        )
+def _hash_keys(keys):
+    # First 8 bytes of the md5 digest, i.e. the first 16 hex digits.
+    return np.fromiter(
+        (
+            int.from_bytes(hashlib.md5(x.encode("utf8")).digest()[:8], "big")
+            for x in keys
+        ),
+        dtype=np.uint64,
+        count=len(keys),
+    )
+
+
+def _parse_frame(df, type_):
+    df = df[_get_columns(type_)]
 
-    df.index = (
-        df["key"]
-        .apply(lambda x: int(hashlib.md5(x.encode("utf8")).hexdigest()[:16], base=16))
-        .values
+    column_timestamp = "pickup_datetime"
+    df[column_timestamp] = pandas.to_datetime(
+        df[column_timestamp].str.slice(0, 19), format="%Y-%m-%d %H:%M:%S"
     )
+
+    df.index = _hash_keys(df["key"].values)
     return df
 
 
-def convert_to_parquet():
-    files = glob.glob(os.path.join(DATA_FOLDER, "raw", "parts_train*.csv"))
-    files += glob.glob(os.path.join(DATA_FOLDER, "raw", "test*.csv"))
-    for fl in sorted(files):
-        logging.info("Loading {}".format(fl))
-        if "train" in fl:
-            if "00.csv" in fl:
-                kwargs = {"type_": "train", "header": 0}
-            else:
-                kwargs = {"type_": "train", "header": None}
+def _parse_data(file_obj, type_, header, limit_lines=None):
+    read_kwargs = {}
+    read_kwargs["header"] = header
+    read_kwargs["dtype"] = RAW_DTYPES
+    if isinstance(limit_lines, int) and (limit_lines > 0):
+        read_kwargs["nrows"] = limit_lines
+
+    df = pandas.read_csv(file_obj, **read_kwargs)
+    if header is None:
+        df.columns = _get_columns(type_)
+    return _parse_frame(df, type_)
+
+
+@contextlib.contextmanager
+def _open_source(source, member):
+    if not source.endswith(".zip"):
+        with open(source, "rb") as f:
+            yield f
+        return
+    with zipfile.ZipFile(source) as archive, archive.open(member) as f:
+        yield f
+
+
+def _parse_chunks(reader, type_, fl):
+    # Each chunk is pulled from read_csv inside the stage, so the record covers
+    # the CSV tokenizing and not only the frame conversion.
+    reader = iter(reader)
+    while True:
+        with instrumentation.stage("csv_parse", fl, rows=0) as record:
+            chunk = next(reader, None)
+            if chunk is not None:
+                df = _parse_frame(chunk, type_)
+                record["rows"] = len(df)
+        if chunk is None:
+            return
+        yield df
+
+
+def _write_row_groups(frames, fl_save):
+    writer = None
+    with instrumentation.stage("ingest", fl_save, rows=0) as record:
+        with atomic_path(fl_save) as fl_tmp:
+            for chunk in frames:
+                with instrumentation.stage("parquet_write", fl_save, rows=len(chunk)):
+                    table = pyarrow.Table.from_pandas(chunk)
+                    if writer is None:
+                        writer = pyarrow.parquet.ParquetWriter(fl_tmp, table.schema)
+                    writer.write_table(table)
+                record["rows"] += len(chunk)
+            writer.close()
+    logging.info("Saved {}".format(fl_save))
+
+
+def _month_labels(timestamps):
+    labels = np.datetime_as_string(np.asarray(timestamps, dtype="datetime64[M]"))
+    labels[labels == "NaT"] = PARTITION_MISSING
+    return labels
+
+
+def _spill_partitions(frames, folder_tmp):
+    writers = {}
+    try:
+        for df in frames:
+            labels = _month_labels(df["pickup_datetime"].values)
+            with instrumentation.stage("partition_spill", folder_tmp, rows=len(df)):
+                for label in np.unique(labels):
+                    table = pyarrow.Table.from_pandas(df[labels == label])
+                    if label not in writers:
+                        writers[label] = pyarrow.parquet.ParquetWriter(
+                            os.path.join(folder_tmp, label + ".parquet"), table.schema
+                        )
+                    writers[label].write_table(table)
+    finally:
+        for writer in writers.values():
+            writer.close()
+    return sorted(writers)
+
+
+def _write_partition(fl_piece, fl_save, row_group_size):
+    with instrumentation.stage("partition_sort", fl_save) as record:
+        df = pandas.read_parquet(fl_piece)
+        df = df.sort_values("pickup_datetime", kind="stable")
+        record["rows"] = len(df)
+    with instrumentation.stage("parquet_write", fl_save, rows=len(df)):
+        with atomic_path(fl_save) as fl_tmp:
+            pyarrow.parquet.write_table(
+                pyarrow.Table.from_pandas(df),
+                fl_tmp,
+                row_group_size=row_group_size,
+                write_statistics=True,
+            )
+    logging.info("Saved {}".format(fl_save))
+    return fl_save
+
+
+def write_partitions(
+    frames, type_, folder_output, row_group_size=ROW_GROUP_SIZE, workers=1
+):
+    folder_tmp = os.path.join(folder_output, ".partitions_{}".format(type_))
+    shutil.rmtree(folder_tmp, ignore_errors=True)
+    os.makedirs(folder_tmp)
+    try:
+        labels = _spill_partitions(frames, folder_tmp)
+        tasks = [
+            (
+                os.path.join(folder_tmp, label + ".parquet"),
+                os.path.join(folder_output, "{}_{}.parquet".format(type_, label)),
+                row_group_size,
+            )
+            for label in labels
+        ]
+        saved_files = run_parallel(_write_partition, tasks, workers)
+    finally:
+        shutil.rmtree(folder_tmp, ignore_errors=True)
+    return saved_files
+
+
+def _iter_parquet_frames(files, batch_rows):
+    for fl in files:
+        parquet_file = pyarrow.parquet.ParquetFile(fl)
+        for batch in parquet_file.iter_batches(batch_size=batch_rows):
+            yield batch.to_pandas()
+
+
+def partition_parquet(
+    type_, folder_output, chunk_rows=250000, row_group_size=ROW_GROUP_SIZE, workers=1
+):
+    folder_raw = os.path.join(DATA_FOLDER, "raw")
+    files = sorted(
+        x
+        for x in glob.glob(os.path.join(folder_raw, "*{}*.parquet".format(type_)))
+        if not fnmatch.fnmatch(os.path.basename(x), PARTITION_PATTERN.format(type_))
+    )
+    fl_group = os.path.join(folder_output, "partitions_{}".format(type_))
+    params = {
+        "stage": "partition",
+        "type_": type_,
+        "row_group_size": row_group_size,
+        "code": cache.code_hash(_spill_partitions, _write_partition),
+    }
+    if cache.skip_if_fresh(fl_group, files, params):
+        return cache.read_manifest(fl_group)["outputs"]
+    saved_files = write_partitions(
+        _iter_parquet_frames(files, chunk_rows),
+        type_,
+        folder_output,
+        row_group_size,
+        workers,
+    )
+    cache.record(fl_group, files, params, outputs=saved_files)
+    return saved_files
+
+
+def ingest_csv(
+    source,
+    type_,
+    folder_output,
+    member=None,
+    chunk_rows=250000,
+    rows_per_file=1000000,
+    layout="parts",
+    row_group_size=ROW_GROUP_SIZE,
+    workers=1,
+):
+    if member is None:
+        member = "{}.csv".format(type_)
+    prefix = "parts_{}".format(type_)
+    if layout == "month":
+        prefix = "partitions_{}".format(type_)
+    fl_group = os.path.join(folder_output, prefix)
+    params = {
+        "stage": "ingest",
+        "type_": type_,
+        "member": member,
+        "chunk_rows": chunk_rows,
+        "rows_per_file": rows_per_file,
+        "code": cache.code_hash(_parse_frame, _parse_chunks, _write_row_groups),
+    }
+    if layout == "month":
+        params["row_group_size"] = row_group_size
+        params["code"] = cache.code_hash(
+            _parse_frame, _spill_partitions, _write_partition
+        )
+    if cache.skip_if_fresh(fl_group, [source], params):
+        return cache.read_manifest(fl_group)["outputs"]
+    if layout == "month":
+        with _open_source(source, member) as f:
+            reader = pandas.read_csv(f, header=0, dtype=RAW_DTYPES, chunksize=chunk_rows)
+            frames = _parse_chunks(reader, type_, source)
+            saved_files = write_partitions(
+                frames, type_, folder_output, row_group_size, workers
+            )
+        cache.record(fl_group, [source], params, outputs=saved_files)
+        return saved_files
+    chunks_per_file = max(1, -(-rows_per_file // chunk_rows))
+    saved_files = []
+    with _open_source(source, member) as f:
+        reader = pandas.read_csv(f, header=0, dtype=RAW_DTYPES, chunksize=chunk_rows)
+        reader = _parse_chunks(reader, type_, source)
+        while True:
+            first = next(reader, None)
+            if first is None:
+                break
+            chunks = itertools.chain(
+                [first], itertools.islice(reader, chunks_per_file - 1)
+            )
+            fl_save = os.path.join(
+                folder_output, "{}{:02d}.parquet".format(prefix, len(saved_files))
+            )
+            _write_row_groups(chunks, fl_save)
+            saved_files.append(fl_save)
+    cache.record(fl_group, [source], params, outputs=saved_files)
+    return saved_files
+
+
+def _convert_file(fl):
+    fl_save = fl.replace(".csv", ".parquet")
+    params = {"stage": "raw", "code": cache.code_hash(_parse_data, _parse_frame)}
+    if cache.skip_if_fresh(fl_save, [fl], params):
+        return fl_save
+    logging.info("Loading {}".format(fl))
+    if "train" in fl:
+        if "00.csv" in fl:
+            kwargs = {"type_": "train", "header": 0}
         else:
-            kwargs = {"type_": "test", "header": 0}
+            kwargs = {"type_": "train", "header": None}
+    else:
+        kwargs = {"type_": "test", "header": 0}
+    with instrumentation.stage("csv_parse", fl) as record:
         with open(fl, "r") as f:
             df = _parse_data(f, **kwargs)
-        fl_save = fl.replace(".csv", ".parquet")
-        df.to_parquet(fl_save)
-        logging.info("Saved {}".format(fl_save))
+        record["rows"] = len(df)
+    with instrumentation.stage("parquet_write", fl_save, rows=len(df)):
+        atomic_write_parquet(df, fl_save)
+    cache.record(fl_save, [fl], params)
+    logging.info("Saved {}".format(fl_save))
+    return fl_save
 
 
-def get_data_files():
-    files_train = glob.glob(os.path.join(DATA_FOLDER, "raw", "*train*.parquet"))
-    files_test = glob.glob(os.path.join(DATA_FOLDER, "raw", "*test*.parquet"))
-    return sorted(files_train), sorted(files_test)
+def convert_to_parquet(workers=1):
+    files = glob.glob(os.path.join(DATA_FOLDER, "raw", "parts_train*.csv"))
+    files += glob.glob(os.path.join(DATA_FOLDER, "raw", "test*.csv"))
+    return run_parallel(_convert_file, [(fl,) for fl in sorted(files)], workers)
+
+
+def _row_group_matches(statistics, op, value):
+    if statistics is None or not statistics.has_min_max:
+        return True
+    low, high = statistics.min, statistics.max
+    values = list(value) if op in ("in", "not in") else [value]
+    if isinstance(low, datetime.datetime):
+        low, high = pandas.Timestamp(low), pandas.Timestamp(high)
+        values = [pandas.Timestamp(x) for x in values]
+    if op in ("=", "==", "in"):
+        return any(low <= x <= high for x in values)
+    if op in ("<", "<="):
+        return FILTER_OPERATORS[op](low, values[0])
+    if op in (">", ">="):
+        return FILTER_OPERATORS[op](high, values[0])
+    return True
+
+
+def matching_row_groups(parquet_file, filters=None):
+    metadata = parquet_file.metadata
+    row_groups = []
+    for position in range(metadata.num_row_groups):
+        row_group = metadata.row_group(position)
+        columns = {
+            row_group.column(j).path_in_schema: row_group.column(j).statistics
+            for j in range(row_group.num_columns)
+        }
+        if all(
+            _row_group_matches(columns.get(column), op, value)
+            for column, op, value in filters or []
+        ):
+            row_groups.append(position)
+    return row_groups
+
+
+def filter_frame(df, filters=None):
+    if not filters:
+        return df
+    flter = np.ones(len(df), dtype=bool)
+    for column, op, value in filters:
+        if op == "in":
+            flter &= df[column].isin(value).values
+        elif op == "not in":
+            flter &= ~df[column].isin(value).values
+        else:
+            flter &= FILTER_OPERATORS[op](df[column], value).values
+    return df[flter]
+
+
+def get_data_files(filters=None):
+    folder = os.path.join(DATA_FOLDER, "raw")
+    files = []
+    for type_ in ["train", "test"]:
+        # Prefer the month partitions when both layouts are present.
+        fls = glob.glob(os.path.join(folder, PARTITION_PATTERN.format(type_)))
+        if not fls:
+            fls = glob.glob(os.path.join(folder, "*{}*.parquet".format(type_)))
+        if filters:
+            fls = [
+                x
+                for x in fls
+                if matching_row_groups(pyarrow.parquet.ParquetFile(x), filters)
+            ]
+        files.append(sorted(fls))
+    return tuple(files)
+
+
+def get_refined_files(stage, files):
+    # Refined files are named after their raw file, so they follow the layout
+    # get_data_files picked even when files of the other layout remain.
+    folder = os.path.join(DATA_FOLDER, "refined")
+    return [
+        os.path.join(folder, "{}_{}".format(stage, os.path.basename(x))) for x in files
+    ]
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", default="split")
+    parser.add_argument("--source", default=None)
+    parser.add_argument("--folder", default=os.path.join(DATA_FOLDER, "raw"))
+    parser.add_argument("--chunk_rows", type=int, default=250000)
+    parser.add_argument("--rows_per_file", type=int, default=1000000)
+    parser.add_argument("--layout", default="parts")
+    parser.add_argument("--row_group_size", type=int, default=ROW_GROUP_SIZE)
+    parser.add_argument("--workers", type=int, default=1)
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+
     logging.basicConfig(level=logging.INFO)
-    convert_to_parquet()
+    instrumentation.configure_from_args(args)
+
+    if args.mode == "split":
+        convert_to_parquet(args.workers)
+    if args.mode == "stream":
+        if args.source.endswith(".zip"):
+            types = ["train", "test"]
+        else:
+            types = ["train" if "train" in os.path.basename(args.source) else "test"]
+        for type_ in types:
+            ingest_csv(
+                args.source,
+                type_,
+                args.folder,
+                chunk_rows=args.chunk_rows,
+                rows_per_file=args.rows_per_file,
+                layout=args.layout,
+                row_group_size=args.row_group_size,
+                workers=args.workers,
+            )
+    if args.mode == "partition":
+        for type_ in ["train", "test"]:
+            partition_parquet(
+                type_,
+                args.folder,
+                chunk_rows=args.chunk_rows,
+                row_group_size=args.row_group_size,
+                workers=args.workers,
+            )
+    instrumentation.finish(args)
@@ -0,0 +1,63 @@
+import os
+import contextlib
+import concurrent.futures
+import pyarrow
+import pyarrow.parquet
+
+import src.instrumentation as instrumentation
+
+
+def run_parallel(func, tasks, workers=1, max_in_flight=None):
+    tasks = list(tasks)
+    if workers is None or workers <= 1:
+        return [func(*task) for task in tasks]
+    if max_in_flight is None:
+        max_in_flight = workers
+    results = [None] * len(tasks)
+    iterator = iter(enumerate(tasks))
+    config = instrumentation.get_config()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = {}
+
+        def submit_next():
+            for position, task in iterator:
+                future = executor.submit(
+                    instrumentation.call_with_records, config, func, *task
+                )
+                pending[future] = position
+                return
+
+        for _ in range(max_in_flight):
+            submit_next()
+        while pending:
+            done, _ = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                result, records = future.result()
+                results[pending.pop(future)] = result
+                instrumentation.extend(records)
+                submit_next()
+    return results
+
+
+@contextlib.contextmanager
+def atomic_path(fl_save):
+    folder, base = os.path.split(fl_save)
+    fl_tmp = os.path.join(folder, ".{}.{}.tmp".format(base, os.getpid()))
+    try:
+        yield fl_tmp
+        os.replace(fl_tmp, fl_save)
+    finally:
+        if os.path.exists(fl_tmp):
+            os.remove(fl_tmp)
+
+
+def atomic_write_parquet(df, fl_save, metadata=None):
+    with atomic_path(fl_save) as fl_tmp:
+        if metadata is None:
+            df.to_parquet(fl_tmp)
+            return
+        table = pyarrow.Table.from_pandas(df)
+        table = table.replace_schema_metadata({**table.schema.metadata, **metadata})
+        pyarrow.parquet.write_table(table, fl_tmp)